@@ -1,10 +1,23 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
 from mwrogue.esports_client import EsportsClient
 from esports_cog_utils import utils
-from redbot.core import commands, app_commands
+from redbot.core import commands, app_commands, checks
 from redbot.core.bot import Red
+from redbot.core.data_manager import cog_data_path
+from redbot.core.utils.chat_formatting import pagify
+
+from .players import get_player_cache
 
 from .autorosters_main import AutoRostersRunner
 
+# Number of tournaments whose data is queried at the same time in batch mode
+BATCH_MAX_WORKERS = 4
+# The tournaments are already queried concurrently, so each of them sends its query chunks one at a time
+# to keep the number of requests in flight at BATCH_MAX_WORKERS
+BATCH_CARGO_MAX_WORKERS = 1
+
 
 class AutoRosters(commands.Cog):
     """Automatically generates team rosters for Leaguepedia, using scoreboard data"""
@@ -13,6 +26,13 @@ class AutoRosters(commands.Cog):
         super().__init__(*args, **kwargs)
         self.bot = bot
 
+    @staticmethod
+    def get_wiki_url(title: str):
+        return f"https://lol.fandom.com/wiki/{title}".replace(" ", "_")
+
+    def get_cache_dir(self):
+        return str(cog_data_path(self) / "tournaments")
+
     async def run(self, ctx, overview_page: str, query_coaches: bool = False):
         await ctx.send('Okay, starting now!')
         credentials = await utils.get_credentials(ctx, self.bot)
@@ -22,17 +42,18 @@ class AutoRosters(commands.Cog):
         overview_page = site.cache.get_target(overview_page)
         if not site.client.pages[overview_page].exists:
             return await ctx.send('The tournament page does not exist!')
-        runner = AutoRostersRunner(site, overview_page, query_coaches)
-        runner.run()
-        username = site.credentials.username
-        username = username.split('@')[0] if "@" in username else username
-        sandbox_page = f"https://lol.fandom.com/wiki/User:{username}/Team_Rosters_Sandbox".replace(" ", "_")
+        runner = AutoRostersRunner(site, overview_page, query_coaches, cache_dir=self.get_cache_dir(),
+                                   player_cache=get_player_cache())
+        saved = runner.run()
+        sandbox_page = self.get_wiki_url(runner.get_sandbox_title())
         rosters_page = f"https://lol.fandom.com/wiki/{overview_page}/Team_Rosters".replace(" ", "_")
         done_message = "Okay, done!"
         if query_coaches:
             done_message += " **Remember to complete the coaches' fields!**"
         else:
             done_message += " **Remember the generated content has no coaches!**"
+        if not saved:
+            done_message += "\nThe sandbox page already had this content, so it was not edited."
         await ctx.send(f"{done_message}\nHere is the sandbox page with the new content:\n<{sandbox_page}>\n"
                        f"Here is where you should copy it:\n<{rosters_page}>")
         await runner.send_warnings(ctx)
@@ -48,3 +69,75 @@ class AutoRosters(commands.Cog):
     async def autorostersc(self, ctx, *, overview_page: str):
         """Generates team rosters for the specified tournament querying for team coaches"""
         await self.run(ctx, overview_page, query_coaches=True)
+
+    @commands.hybrid_command(name="autorostersbatch", pass_context=True)
+    @app_commands.describe(title_list="A comma separated list of tournament overview pages")
+    async def autorostersbatch(self, ctx, *, title_list: str):
+        """Generates team rosters for many tournaments at once, each one in its own sandbox subpage"""
+        await ctx.send('Okay, starting now!')
+        credentials = await utils.get_credentials(ctx, self.bot)
+        site = EsportsClient('lol', credentials=credentials,
+                             max_retries_mwc=0,
+                             max_retries=2, retry_interval=10)
+        overview_pages = list(dict.fromkeys(site.cache.get_target(title.strip())
+                                            for title in title_list.split(",") if title.strip()))
+        missing_pages = [title for title in overview_pages if not site.client.pages[title].exists]
+        runners = [AutoRostersRunner(site, title, cache_dir=self.get_cache_dir(), sandbox_subpage=title,
+                                     player_cache=get_player_cache(), cargo_max_workers=BATCH_CARGO_MAX_WORKERS)
+                   for title in overview_pages if title not in missing_pages]
+
+        # Querying is read-only, so every tournament is processed concurrently, the edits are then made one by one
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS) as executor:
+            outputs = await asyncio.gather(*(loop.run_in_executor(executor, runner.generate) for runner in runners),
+                                           return_exceptions=True)
+
+        done_lines = []
+        failed_pages = []
+        for runner, output in zip(runners, outputs):
+            if isinstance(output, Exception):
+                failed_pages.append(f"`{runner.overview_page}` ({type(output).__name__}: {output})")
+                continue
+            try:
+                saved = await loop.run_in_executor(None, runner.save_page, output)
+                await loop.run_in_executor(None, runner.save_cache)
+            except Exception as e:
+                # One failed edit shouldn't keep the other tournaments from being saved and reported
+                failed_pages.append(f"`{runner.overview_page}` ({type(e).__name__}: {e})")
+                continue
+            done_lines.append(f"`{runner.overview_page}`: <{self.get_wiki_url(runner.get_sandbox_title())}>"
+                              + ("" if saved else " (unchanged)"))
+
+        for page in pagify("Okay, done! **Remember the generated content has no coaches!**\n" + "\n".join(done_lines)):
+            await ctx.send(page)
+        if missing_pages:
+            await ctx.send("These tournament pages do not exist: " + ", ".join(f"`{p}`" for p in missing_pages))
+        if failed_pages:
+            for page in pagify("These tournaments could not be generated or saved:\n" + "\n".join(failed_pages)):
+                await ctx.send(page)
+        for runner in runners:
+            if runner.warnings:
+                await ctx.send(f"Warnings for `{runner.overview_page}`:")
+                await runner.send_warnings(ctx)
+
+    @commands.hybrid_command(name="autorostersreset", pass_context=True)
+    @app_commands.describe(overview_page="The overview page of the tournament")
+    async def autorostersreset(self, ctx, *, overview_page: str):
+        """Forgets the stored data of a tournament, so that its next run regenerates everything from scratch"""
+        credentials = await utils.get_credentials(ctx, self.bot)
+        site = EsportsClient('lol', credentials=credentials,
+                             max_retries_mwc=0,
+                             max_retries=2, retry_interval=10)
+        overview_page = site.cache.get_target(overview_page)
+        if AutoRostersRunner.clear_cache(self.get_cache_dir(), overview_page):
+            return await ctx.send(f"Okay, the stored data for `{overview_page}` has been cleared!")
+        await ctx.send(f"There is no stored data for `{overview_page}`.")
+
+    @commands.hybrid_command(name="clearplayercache", pass_context=True)
+    @checks.mod_or_permissions(manage_guild=True)
+    @app_commands.describe(players="A comma separated list of player pages or names, leave empty to clear every player")
+    async def clearplayercache(self, ctx, *, players: str = ""):
+        """Forgets the cached metadata of the given players, so that the wiki cogs query it again"""
+        players = [player.strip() for player in players.split(",") if player.strip()]
+        count = get_player_cache().invalidate(players or None)
+        await ctx.send(f"Okay, cleared the cached metadata of {count} player(s)!")
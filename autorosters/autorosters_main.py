@@ -3,7 +3,12 @@ from typing import Optional
 from esports_cog_utils.task_runner import TaskRunner
 from mwrogue.esports_client import EsportsClient
 from mwrogue.auth_credentials import AuthCredentials
+from .cargo import CARGO_IN_MAX_WORKERS, query_in_chunks
+from .players import PlayerMetadataCache, lookup_players
+from .storage import read_json, remove_file, write_json
+import hashlib
 import math
+import os
 import re
 
 
@@ -22,30 +27,113 @@ class AutoRostersRunner(TaskRunner):
         "Coach": 6
     }
 
-    def __init__(self, site: EsportsClient, overview_page: str, query_coaches: bool = False):
+    # Bump whenever the format of the cached state changes, older caches are then ignored
+    CACHE_VERSION = 3
+
+    def __init__(self, site: EsportsClient, overview_page: str, query_coaches: bool = False,
+                 cache_dir: Optional[str] = None, sandbox_subpage: Optional[str] = None,
+                 player_cache: Optional[PlayerMetadataCache] = None,
+                 cargo_max_workers: int = CARGO_IN_MAX_WORKERS):
         super().__init__()
         self.site = site
         self.overview_page = overview_page
+        self.sandbox_subpage = sandbox_subpage
+        self.cache_file = self.get_cache_file(cache_dir, overview_page) if cache_dir else None
+        self.cached_games = {}
+        self.player_cache = player_cache
+        # Chunks of a single query that are sent at the same time
+        self.cargo_max_workers = cargo_max_workers
         self.tabs: Optional[str] = None
         self.match_data = {}
         self.alt_teamnames = {}
         self.rosters_data = {}
-        self.coaches = {}
+        self.coaches = []
+        self.player_info = {}
+        self.games_matrix = {}
         self.query_coaches = query_coaches
 
     def run(self):
+        output = self.generate()
+        saved = self.save_page(output)
+        self.save_cache()
+        return saved
+
+    def generate(self):
+        """Queries and processes all the data of the tournament without editing anything, returning the page text"""
         self.get_tabs()
+        self.load_cache()
         matchschedule_data = self.query_matchschedule_data()
         scoreboard_data = self.query_scoreboard_data(matchschedule_data)
         self.process_matchschedule_data(matchschedule_data)
-        self.process_scoreboard_data(scoreboard_data)
         self.query_tournament_coaches()
+        self.process_scoreboard_data(scoreboard_data)
+        self.restore_cached_games()
+        # Cached games keep the links as written on the scoreboard, so a player page that was moved
+        # or a redirect that was changed since they were cached is picked up here
+        self.fetch_player_info([player["link"] for match in self.match_data.values()
+                                for game in match["games"].values() if "sb_data" in game
+                                for player in game["sb_data"]["players"]] +
+                               [coach["link"] for coach in self.coaches])
+        self.resolve_scoreboard_data()
         self.initialize_roster_data()
         self.add_coaches_to_roster_data()
-        players_data = self.get_player_data()
         self.process_game_data()
-        output = self.make_output(players_data)
-        self.save_page(output)
+        return self.make_output()
+
+    @staticmethod
+    def get_cache_file(cache_dir, overview_page):
+        return os.path.join(cache_dir, f"{hashlib.sha1(overview_page.encode('utf-8')).hexdigest()}.json")
+
+    def load_cache(self):
+        """Loads the scoreboard data of the games already queried in the previous run"""
+        if self.cache_file is None:
+            return
+        cache = read_json(self.cache_file)
+        # A missing or unreadable cache only means that every game is queried again
+        if not isinstance(cache, dict) or cache.get("version") != self.CACHE_VERSION:
+            return
+        if cache.get("overview_page") != self.overview_page:
+            return
+        self.cached_games = cache["games"]
+
+    @staticmethod
+    def has_scoreboard(msg_data):
+        """Forfeited games and games of matches without a winner are not shown with scoreboard data"""
+        return not msg_data["MSFF"] and not msg_data["MSGFF"] and msg_data["MatchWinner"]
+
+    def is_cached(self, msg_data):
+        # Cargo stores the rows of a page again with new ids whenever the page is saved or purged,
+        # so a cached game is still up to date as long as its ScoreboardGames row id didn't change
+        cached_game = self.cached_games.get(msg_data["GameId"])
+        if cached_game is None or msg_data["SGRowId"] is None:
+            return False
+        return cached_game["key"] == msg_data["SGRowId"]
+
+    def restore_cached_games(self):
+        for match in self.match_data.values():
+            for game in match["games"].values():
+                msg_data = game["msg_data"]
+                if "sb_data" in game or not self.has_scoreboard(msg_data) or not self.is_cached(msg_data):
+                    continue
+                cached_game = self.cached_games[msg_data["GameId"]]
+                game["sb_data"] = {"team1": cached_game["team1"], "team2": cached_game["team2"],
+                                   "players": cached_game["players"]}
+
+    def save_cache(self):
+        if self.cache_file is None:
+            return
+        cache = {
+            "version": self.CACHE_VERSION,
+            "overview_page": self.overview_page,
+            "games": {game_id: {**game["sb_data"], "key": game["msg_data"]["SGRowId"]}
+                      for match in self.match_data.values() for game_id, game in match["games"].items()
+                      if "sb_data" in game and game["msg_data"]["SGRowId"] is not None},
+        }
+        write_json(self.cache_file, cache)
+
+    @classmethod
+    def clear_cache(cls, cache_dir, overview_page):
+        return remove_file(cls.get_cache_file(cache_dir, overview_page))
 
     def get_tabs(self):
         page = self.site.client.pages[self.overview_page]
@@ -55,38 +143,38 @@ class AutoRostersRunner(TaskRunner):
 
     def query_matchschedule_data(self):
         matchschedule_data = self.site.cargo_client.query(
-            tables="MatchSchedule=MS, MatchScheduleGame=MSG",
+            tables="MatchSchedule=MS, MatchScheduleGame=MSG, ScoreboardGames=SG",
             fields=["MS.MatchId", "MSG.GameId", "MS.FF=MSFF", "MSG.FF=MSGFF", "MS.BestOf", "MS.Team1Final",
-                    "MS.Team2Final", "MS.Team1", "MS.Team2", "MS.Winner=MatchWinner"],
-            join_on="MS.MatchId=MSG.MatchId",
+                    "MS.Team2Final", "MS.Team1", "MS.Team2", "MS.Winner=MatchWinner", "SG._ID=SGRowId"],
+            join_on="MS.MatchId=MSG.MatchId, MSG.GameId=SG.GameId",
             where=f"MS.OverviewPage = '{self.overview_page}' AND MS.Team1 != \"TBD\" AND MS.Team2 != \"TBD\"",
             order_by="MS.N_Page, MS.N_MatchInPage, MSG.N_GameInMatch"
         )
         return matchschedule_data
 
-    @staticmethod
-    def get_where_scoreboard_data(matchschedule_data):
-        where = "SG.GameId IN ({})"
+    def get_scoreboard_game_ids(self, matchschedule_data):
         gameids_to_query = []
         for game in matchschedule_data:
-            if game["MSFF"] or game["MSGFF"]:
+            if not self.has_scoreboard(game):
                 continue
-            if not game["MatchWinner"]:
+            if self.is_cached(game):
                 continue
-            gameids_to_query.append(f"\"{game['GameId']}\"")
-        where = where.format(" ,".join(gameids_to_query))
-        return where
+            gameids_to_query.append(game["GameId"])
+        return gameids_to_query
 
     def query_scoreboard_data(self, matchschedule_data):
-        where = self.get_where_scoreboard_data(matchschedule_data)
-        scoreboard_data = self.site.cargo_client.query(
+        game_ids = self.get_scoreboard_game_ids(matchschedule_data)
+        scoreboard_data = query_in_chunks(
+            self.site, "SG.GameId", game_ids, max_workers=self.cargo_max_workers,
             tables="ScoreboardGames=SG, ScoreboardPlayers=SP",
             fields=["SG.OverviewPage", "SG.Team1", "SG.Team2", "SP.IngameRole", "SP.Team", "SP.Link", "SG.GameId",
                     "SG.MatchId"],
             order_by="SG.N_Page, SG.N_MatchInPage, SG.N_GameInMatch",
-            where=where,
             join_on="SG.GameId=SP.GameId"
         )
+        # Every chunk is ordered on its own, restore the schedule order across chunks
+        game_positions = {game_id: i for i, game_id in enumerate(game_ids)}
+        scoreboard_data.sort(key=lambda row: game_positions.get(row["GameId"], len(game_positions)))
         return scoreboard_data
 
     def process_matchschedule_data(self, matchschedule_data):
@@ -100,34 +188,50 @@ class AutoRostersRunner(TaskRunner):
                 self.alt_teamnames[match["Team2"]] = match["Team2Final"]
             self.match_data[match["MatchId"]]["games"][match["GameId"]] = {"msg_data": match}
 
+    def fetch_player_info(self, all_names):
+        """Fetches the player page, flag, residency and display name of every given AllName in one query set"""
+        all_names = [name for name in all_names if name and self.get_player_info(name) is None]
+        players = lookup_players(self.site, all_names, self.player_cache, self.cargo_max_workers)
+        for all_name, info in players.items():
+            # Index by both the redirect and the player page, plus lowercase fallbacks
+            # because Cargo compares case-insensitively
+            for key in (all_name, info["player"], info["player"].lower()):
+                self.player_info.setdefault(key, info)
+
+    def get_player_info(self, player):
+        return self.player_info.get(player) or self.player_info.get(player.lower())
+
     def get_player_id(self, player):
-        response = self.site.cargo_client.query(
-            tables="Players=P, PlayerRedirects=PR",
-            fields="P.Player",
-            where=f"PR.AllName = \"{player}\"",
-            join_on="P.OverviewPage=PR.OverviewPage"
-        )
-        if not response:
+        info = self.get_player_info(player)
+        if info is None:
             return player
-        return response[0]["Player"]
+        return info["player"]
 
     def process_scoreboard_data(self, scoreboard_data):
-        player_ids_cache = {}
-
         for scoreboard in scoreboard_data:
             game_data = self.match_data[scoreboard["MatchId"]]["games"][scoreboard["GameId"]]
-            if "sg_data" not in game_data.keys():
-                game_data["sg_data"] = {
+            if "sb_data" not in game_data.keys():
+                game_data["sb_data"] = {
                     "team1": scoreboard["Team1"],
                     "team2": scoreboard["Team2"],
-                    "players": {}}
-            if scoreboard["Link"] not in player_ids_cache:
-                player_id = self.get_player_id(scoreboard["Link"])
-                player_ids_cache[scoreboard["Link"]] = player_id
-            player_page = player_ids_cache[scoreboard["Link"]]
-            game_data["sg_data"]["players"][player_page] = {"role": scoreboard["IngameRole"],
-                                                            "team": scoreboard["Team"],
-                                                            "link": player_page}
+                    "players": []}
+            game_data["sb_data"]["players"].append({"role": scoreboard["IngameRole"],
+                                                    "team": scoreboard["Team"],
+                                                    "link": scoreboard["Link"]})
+
+    def resolve_scoreboard_data(self):
+        """Keys the players of every game by their player page, the scoreboard may link to a redirect"""
+        for match in self.match_data.values():
+            for game in match["games"].values():
+                if "sb_data" not in game:
+                    continue
+                sb_data = game["sb_data"]
+                game["sg_data"] = {"team1": sb_data["team1"], "team2": sb_data["team2"], "players": {}}
+                for player in sb_data["players"]:
+                    player_page = self.get_player_id(player["link"])
+                    game["sg_data"]["players"][player_page] = {"role": player["role"],
+                                                               "team": player["team"],
+                                                               "link": player_page}
 
     def query_tournament_coaches(self):
         if not self.query_coaches:
@@ -148,9 +252,8 @@ class AutoRostersRunner(TaskRunner):
                 player["roles_data"]["roles"] = rolesn
                 for i, role in enumerate(player["roles"]):
                     rolen = f"role{i + 1}"
-                    rolen_short = f"r{i + 1}"
                     player["roles_data"][rolen] = role
-                    player["games_by_role"][rolen_short] = ""
+                    player["role_columns"][role] = i
 
     def initialize_roster_data(self):
         for match in self.match_data.values():
@@ -165,7 +268,7 @@ class AutoRostersRunner(TaskRunner):
                         team_players = self.rosters_data[team]["players"]
                         if player["link"] not in team_players.keys():
                             team_players[player["link"]] = {"roles": [], "roles_data": {},
-                                                            "games_by_role": {}}
+                                                            "role_columns": {}}
                         if player["role"] not in team_players[player["link"]]["roles"]:
                             team_players[player["link"]]["roles"].append(player["role"])
         self.get_players_roles_data()
@@ -175,40 +278,7 @@ class AutoRostersRunner(TaskRunner):
             team = self.alt_teamnames[coach["team"]]
             self.rosters_data[team]["players"][coach["link"]] = {"roles": ["Coach"],
                                                                  "roles_data": {"roles": 1, "role1": "Coach"},
-                                                                 "games_by_role": {}}
-
-    @staticmethod
-    def get_where_player_data(rosters_data):
-        where = "PR.AllName IN ({})"
-
-        players = {}
-        for team in rosters_data.values():
-            for player in team["players"].keys():
-                if player not in players.keys():
-                    players[player] = f"\"{player}\""
-        where = where.format(" ,".join(players.values()))
-        return where
-
-    def get_player_data(self):
-        players_data = {}
-
-        where = self.get_where_player_data(self.rosters_data)
-        response = self.site.cargo_client.query(
-            tables="Players=P, PlayerRedirects=PR, Alphabets=A",
-            join_on="P.OverviewPage=PR.OverviewPage, P.NameAlphabet=A.Alphabet",
-            where=where,
-            fields=["CONCAT(CASE WHEN A.IsTransliterated=\"1\" THEN P.NameFull ELSE P.Name END)=name", "P.Player",
-                    "P.NationalityPrimary=NP", "P.Country", "P.Residency"]
-        )
-
-        for player_data in response:
-            player_name = player_data["name"].replace("&amp;nbsp;", " ") if player_data["name"] is not None else ""
-            players_data[player_data["Player"].capitalize()] = [{"flag": player_data["NP"] or
-                                                                player_data["Country"] or ""},
-                                                                {"res": player_data["Residency"]} or "",
-                                                                {"player": player_data["Player"]},
-                                                                {"name": player_name}]
-        return players_data
+                                                                 "role_columns": {}}
 
     def add_team_vs(self, current_teams):
         n_teams = {}
@@ -221,58 +291,60 @@ class AutoRostersRunner(TaskRunner):
         self.rosters_data[current_teams[0]]["teamsvs"].append({f"team{n_teams[current_teams[0]]}": current_teams[1]})
         self.rosters_data[current_teams[1]]["teamsvs"].append({f"team{n_teams[current_teams[1]]}": current_teams[0]})
 
+    def initialize_games_matrix(self, team):
+        players = list(self.rosters_data[team].get("players", {}).keys())
+        self.games_matrix[team] = {
+            "player_index": {player: i for i, player in enumerate(players)},
+            # One entry per match, either the number of games lost by forfeit
+            # or a list of games, each one holding the role column every player played in, -1 if none
+            "matches": [],
+        }
+
     def process_game_data(self):
+        for team in self.rosters_data.keys():
+            self.initialize_games_matrix(team)
         for match in self.match_data.values():
             current_teams = [self.alt_teamnames[match["team1"]], self.alt_teamnames[match["team2"]]]
             self.add_team_vs(current_teams)
+            for team in current_teams:
+                if team not in self.games_matrix:
+                    self.initialize_games_matrix(team)
             if match["ff"]:
                 for team in current_teams:
-                    if "players" not in self.rosters_data[team].keys():
-                        continue
-                    for player in self.rosters_data[team]["players"].values():
-                        for role in player["games_by_role"].keys():
-                            player["games_by_role"][role] += f"{'n' * math.ceil((int(match['best_of']) + 1) / 2)},"
+                    self.games_matrix[team]["matches"].append(math.ceil((int(match["best_of"]) + 1) / 2))
                 continue
+            match_games = {team: [] for team in current_teams}
             for game in match["games"].values():
-                if game["msg_data"]["MSGFF"] is not None:
-                    for team in current_teams:
-                        if "players" not in self.rosters_data[team].keys():
-                            continue
-                        for player in self.rosters_data[team]["players"].values():
-                            for role in player["games_by_role"].keys():
-                                player["games_by_role"][role] += "n"
+                # Games without scoreboard data aren't shown at all, forfeited games are shown as not played
+                if game["msg_data"]["MSGFF"] is None and "sg_data" not in game.keys():
                     continue
+                game_rows = {team: [-1] * len(self.games_matrix[team]["player_index"]) for team in current_teams}
+                if game["msg_data"]["MSGFF"] is None:
+                    for player, game_sg_player in game["sg_data"]["players"].items():
+                        team = self.alt_teamnames[game_sg_player["team"]]
+                        if team not in game_rows:
+                            continue
+                        player_index = self.games_matrix[team]["player_index"].get(player)
+                        if player_index is None:
+                            continue
+                        role_columns = self.rosters_data[team]["players"][player]["role_columns"]
+                        game_rows[team][player_index] = role_columns.get(game_sg_player["role"], -1)
                 for team in current_teams:
-                    rd_team = self.rosters_data[team]
-                    for player in rd_team["players"].keys():
-                        game_rd_player = rd_team["players"][player]
-                        if "sg_data" in game.keys():
-                            game_sg_players = game["sg_data"]["players"]
-                            if player in game_sg_players.keys():
-                                game_sg_player = game_sg_players[player]
-                                if team == self.alt_teamnames[game_sg_player["team"]]:
-                                    for role in game_rd_player["games_by_role"]:
-                                        lookup_role = role.replace("r", "role")
-                                        role_name = game_rd_player["roles_data"][lookup_role]
-                                        if role_name == game_sg_player["role"]:
-                                            game_rd_player["games_by_role"][role] += "y"
-                                        else:
-                                            game_rd_player["games_by_role"][role] += "n"
-                                    continue
-                            for role in self.rosters_data[team]["players"][player]["games_by_role"]:
-                                game_rd_player["games_by_role"][role] += "n"
+                    match_games[team].append(game_rows[team])
             for team in current_teams:
-                rd_team = self.rosters_data[team]
-                for player in rd_team["players"].keys():
-                    game_rd_player = rd_team["players"][player]
-                    for role in game_rd_player["games_by_role"]:
-                        game_rd_player["games_by_role"][role] += ","
-        for team_data in self.rosters_data.values():
-            if "players" not in team_data.keys():
-                continue
-            for player in team_data["players"].values():
-                for role, role_data in player["games_by_role"].items():
-                    player["games_by_role"][role] = role_data.rstrip(",")
+                self.games_matrix[team]["matches"].append(match_games[team])
+
+    def get_games_by_role(self, team, player):
+        matrix = self.games_matrix[team]
+        player_index = matrix["player_index"][player]
+        games_by_role = {}
+        for column in self.rosters_data[team]["players"][player]["role_columns"].values():
+            games_by_role[f"r{column + 1}"] = ",".join(
+                "n" * match if isinstance(match, int) else
+                "".join("y" if game[player_index] == column else "n" for game in match)
+                for match in matrix["matches"]
+            ).rstrip(",")
+        return games_by_role
 
     def get_order(self):
         sorted_teams = sorted(self.rosters_data.keys(), key=lambda x: x.lower())
@@ -289,62 +361,73 @@ class AutoRostersRunner(TaskRunner):
 
     @staticmethod
     def concat_args(data):
-        ret = ''
         lookup = data
         if type(data) == dict:
-            lookup = []
-            for k, v in data.items():
-                lookup.append({k: v})
+            lookup = [{k: v} for k, v in data.items()]
 
+        parts = []
         for pair in lookup:
             pair: dict
-            for key in pair.keys():
-                if pair[key] is None:
-                    ret = ret + '|{}='.format(key)
-                else:
-                    ret = ret + '|{}={}'.format(key, str(pair[key]))
-        return ret
+            for key, value in pair.items():
+                parts.append(f"|{key}=" if value is None else f"|{key}={value}")
+        return "".join(parts)
 
-    def make_output(self, players_data):
-        output = ""
+    def make_output(self):
+        output = []
         if self.tabs:
-            output += self.PAGE_TABS.format(self.tabs)
+            output.append(self.PAGE_TABS.format(self.tabs))
         else:
             self.warnings.append("There are no tabs on the overview page!")
-        output += self.PAGE_HEADER
+        output.append(self.PAGE_HEADER)
         sorted_data = self.get_order()
         for team in sorted_data["teams"]:
-            players_text = ""
             if not sorted_data["players"][team]:
                 continue
-            team_has_ingame_players = False
-            for player_data in self.rosters_data[team]["players"].values():
-                if all(role == "Coach" for role in player_data["roles"]):
-                    continue
-                team_has_ingame_players = True
-            if not team_has_ingame_players:
+            if all(all(role == "Coach" for role in player_data["roles"])
+                   for player_data in self.rosters_data[team]["players"].values()):
                 continue
-            for player in sorted_data["players"][team]:
-                player = player[0]
+            players_text = []
+            for player, _ in sorted_data["players"][team]:
                 game_rd_player = self.rosters_data[team]["players"][player]
-                if players_data.get(player.capitalize()):
-                    player_data = self.concat_args(players_data[player.capitalize()])
+                if player_info := self.get_player_info(player):
+                    player_data = self.concat_args([{"flag": player_info["flag"]}, {"res": player_info["res"]},
+                                                    {"player": player_info["player"]}, {"name": player_info["name"]}])
                 else:
                     player_data = self.concat_args([{"flag": ""}, {"res": ""}, {"player": player}, {"name": ""}])
                 player_roles_data = self.concat_args(game_rd_player["roles_data"])
-                player_games_by_role = self.concat_args(game_rd_player["games_by_role"])
-                if not game_rd_player["games_by_role"]:
+                games_by_role = self.get_games_by_role(team, player)
+                player_games_by_role = self.concat_args(games_by_role)
+                if not games_by_role:
                     player_games_by_role = "|r1="
-                players_text += self.PLAYER_TEXT.format(player_data, player_roles_data, player_games_by_role)
+                players_text.append(self.PLAYER_TEXT.format(player_data, player_roles_data, player_games_by_role))
             teamsvs = self.concat_args(self.rosters_data[team]["teamsvs"])
-            output += self.TEAM_TEXT.format(team, teamsvs, players_text)
-        return output
+            output.append(self.TEAM_TEXT.format(team, teamsvs, "".join(players_text)))
+        return "".join(output)
 
-    def save_page(self, output):
+    def get_sandbox_title(self):
         username = self.site.credentials.username
         username = username.split('@')[0] if "@" in username else username
-        page = self.site.client.pages[f"User:{username}/Team Rosters Sandbox"]
+        title = f"User:{username}/Team Rosters Sandbox"
+        if self.sandbox_subpage:
+            title += f"/{self.sandbox_subpage}"
+        return title
+
+    def get_current_sha1(self, title):
+        response = self.site.client.api("query", prop="revisions", titles=title, rvprop="sha1", formatversion=2)
+        page = response["query"]["pages"][0]
+        if page.get("missing") or not page.get("revisions"):
+            return None
+        return page["revisions"][0].get("sha1")
+
+    def save_page(self, output):
+        """Saves the output to the sandbox page, returns False if the page already had the same content"""
+        title = self.get_sandbox_title()
+        # MediaWiki strips trailing whitespace when saving, so the stored hash is of the stripped text
+        if self.get_current_sha1(title) == hashlib.sha1(output.rstrip().encode("utf-8")).hexdigest():
+            return False
+        page = self.site.client.pages[title]
         self.site.save(page=page, text=output, summary="Generating Rosters from Scoreboard Data")
+        return True
 
 
 if __name__ == '__main__':
@@ -0,0 +1,169 @@
+import os
+import threading
+import time
+from typing import Iterable, Optional
+
+from mwrogue.esports_client import EsportsClient
+from redbot.core.data_manager import cog_data_path
+
+from .cargo import CARGO_IN_MAX_WORKERS, query_in_chunks
+from .storage import read_json, write_json
+
+# Cached player metadata is queried again after this many seconds
+PLAYER_CACHE_TTL = 24 * 60 * 60
+# Data folder of the player metadata file, it doesn't belong to any single cog
+PLAYER_CACHE_DATA_NAME = "EsportsWikiPlayers"
+
+
+class PlayerMetadataCache:
+    """Disk-persisted cache of player metadata, keyed by the lowercase AllName
+
+    Every entry holds the player page, flag, residency and display name of the player.
+    Cargo compares names case-insensitively, so lookups are case-insensitive too.
+
+    Every cog that looks players up has its own copy of this module, and they all use the same file.
+    The file is read again by refresh() whenever another cache object changed it, entries that were set
+    here but not saved yet are kept on top of it.
+    """
+
+    def __init__(self, path: str, ttl: int = PLAYER_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: dict[str, dict] = {}
+        self._unsaved: set[str] = set()
+        self._mtime: Optional[int] = None
+        self.refresh()
+
+    def _file_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _refresh(self) -> None:
+        mtime = self._file_mtime()
+        if mtime == self._mtime:
+            return
+        entries = read_json(self.path) if mtime is not None else None
+        if not isinstance(entries, dict):
+            entries = {}
+        for key in self._unsaved:
+            entries[key] = self._entries[key]
+        self._entries = entries
+        self._mtime = mtime
+
+    def _write(self) -> None:
+        now = time.time()
+        self._entries = {key: entry for key, entry in self._entries.items() if now - entry["fetched_at"] < self.ttl}
+        write_json(self.path, self._entries)
+        self._unsaved.clear()
+        self._mtime = self._file_mtime()
+
+    def refresh(self) -> None:
+        """Reads the file again if it was changed since it was last read or written by this object"""
+        with self._lock:
+            self._refresh()
+
+    def save(self) -> None:
+        with self._lock:
+            self._refresh()
+            self._write()
+
+    def get(self, all_name: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(all_name.lower())
+        if entry is None or time.time() - entry["fetched_at"] >= self.ttl:
+            return None
+        return entry
+
+    def set(self, all_name: str, metadata: dict) -> None:
+        with self._lock:
+            self._entries[all_name.lower()] = {**metadata, "fetched_at": time.time()}
+            self._unsaved.add(all_name.lower())
+
+    def invalidate(self, all_names: Optional[Iterable[str]] = None) -> int:
+        """Forgets the given names, or every name if none are given, returns the number of forgotten entries
+
+        A name also forgets every entry of the player page with that name, so that clearing a player
+        clears all of their redirects too. Both are compared case-insensitively.
+        """
+        with self._lock:
+            self._refresh()
+            if all_names is None:
+                count = len(self._entries)
+                self._entries = {}
+                self._unsaved.clear()
+            else:
+                names = {name.lower() for name in all_names}
+                keys = {key for key, entry in self._entries.items()
+                        if key in names or (entry.get("player") or "").lower() in names}
+                for key in keys:
+                    del self._entries[key]
+                self._unsaved -= keys
+                count = len(keys)
+            self._write()
+        return count
+
+
+_player_cache: Optional[PlayerMetadataCache] = None
+
+
+def get_player_cache() -> PlayerMetadataCache:
+    """Returns the player metadata cache, its file is shared with every other cog of this repo that looks players up"""
+    global _player_cache
+    if _player_cache is None:
+        path = cog_data_path(raw_name=PLAYER_CACHE_DATA_NAME) / "player_metadata.json"
+        _player_cache = PlayerMetadataCache(str(path))
+    return _player_cache
+
+
+def lookup_players(site: EsportsClient, all_names: Iterable[str], cache: Optional[PlayerMetadataCache] = None,
+                   max_workers: int = CARGO_IN_MAX_WORKERS) -> dict[str, dict]:
+    """Returns the metadata of every given AllName that belongs to a player page, keyed by the lowercase AllName
+
+    Names that are not in the cache are queried in chunks and added to it.
+    An entry is marked as ambiguous when its AllName redirects to more than one player page.
+    """
+    ret = {}
+    to_query = []
+    if cache is not None:
+        cache.refresh()
+    for name in dict.fromkeys(name for name in all_names if name):
+        if cache is not None and (entry := cache.get(name)) is not None:
+            ret[name.lower()] = entry
+        else:
+            to_query.append(name)
+
+    response = query_in_chunks(
+        site, "PR.AllName", to_query, max_workers=max_workers,
+        tables="Players=P, PlayerRedirects=PR, Alphabets=A",
+        join_on="P.OverviewPage=PR.OverviewPage, P.NameAlphabet=A.Alphabet",
+        fields=["PR.AllName", "P.Player",
+                "CONCAT(CASE WHEN A.IsTransliterated=\"1\" THEN P.NameFull ELSE P.Name END)=name",
+                "P.NationalityPrimary=NP", "P.Country", "P.Residency"]
+    )
+
+    queried = {}
+    for player_data in response:
+        if not player_data["Player"]:
+            continue
+        key = player_data["AllName"].lower()
+        if key in queried:
+            if queried[key]["player"] != player_data["Player"]:
+                queried[key]["ambiguous"] = True
+            continue
+        queried[key] = {
+            "player": player_data["Player"],
+            "flag": player_data["NP"] or player_data["Country"] or "",
+            "res": player_data["Residency"] or "",
+            "name": player_data["name"].replace("&amp;nbsp;", " ") if player_data["name"] is not None else "",
+            "ambiguous": False,
+        }
+
+    if cache is not None and queried:
+        for key, entry in queried.items():
+            cache.set(key, entry)
+        cache.save()
+    ret.update(queried)
+    return ret
@@ -0,0 +1,52 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+
+from mwrogue.esports_client import EsportsClient
+
+# Number of values in a single IN (...) clause, large enough to save round trips
+# while keeping the request URL well below the wiki's limits
+CARGO_IN_CHUNK_SIZE = 50
+# Maximum number of chunks queried at the same time
+CARGO_IN_MAX_WORKERS = 4
+
+
+def quote_cargo_values(values: Iterable) -> str:
+    return " ,".join('"{}"'.format(str(value).replace('"', '\\"')) for value in values)
+
+
+def query_in_chunks(site: EsportsClient, field: str, values: Iterable, where: Optional[str] = None,
+                    chunk_size: int = CARGO_IN_CHUNK_SIZE, max_workers: int = CARGO_IN_MAX_WORKERS,
+                    **kwargs) -> list:
+    """Runs a Cargo query with a `field IN (...)` condition split into batches of chunk_size values
+
+    The batches are queried concurrently and their results are merged in batch order,
+    each batch is paginated by the Cargo client like any other query.
+    Any other keyword arguments are passed to site.cargo_client.query.
+    """
+    values = [value for value in dict.fromkeys(values) if value is not None]
+    if not values:
+        return []
+    chunks = [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+
+    def query_chunk(chunk):
+        chunk_where = f"{field} IN ({quote_cargo_values(chunk)})"
+        if where:
+            chunk_where = f"({where}) AND {chunk_where}"
+        return site.cargo_client.query(where=chunk_where, **kwargs)
+
+    if len(chunks) == 1 or max_workers <= 1:
+        results = [query_chunk(chunk) for chunk in chunks]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+            results = list(executor.map(query_chunk, chunks))
+
+    return [row for result in results for row in result]
+
+
+async def async_query_in_chunks(site: EsportsClient, field: str, values: Iterable, **kwargs) -> list:
+    """Same as query_in_chunks, but runs in an executor so that the event loop isn't blocked"""
+    return await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(query_in_chunks, site, field, list(values), **kwargs)
+    )
@@ -1,11 +1,18 @@
 from redbot.core.bot import Red
 from tsutils.errors import NoAPIKeyException
 from mhtool.errors import RateLimitException, BadRequestException, NotFoundException
+from mhtool.stats import StatsCollector
 
+import asyncio
 import backoff
+import copy
+import json
+import logging
+import time
 
 from typing import Iterable, Literal, Optional, Union, TypedDict
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from dateutil.parser import isoparse
 
 from aiohttp import ClientSession, ClientResponse
 
@@ -13,6 +20,8 @@ import re
 
 FileType = Literal['summary', 'details']
 
+logger = logging.getLogger('red.esports-wiki-cogs.mhtool.grid')
+
 
 class _TournamentBase(TypedDict):
     id: str
@@ -43,6 +52,12 @@ LOL_GRID_TITLE_ID = 3
 LOL_GRID_DATA_PROVIDER = "LOL_LIVE"
 
 END_STATE_FILE_ID_RE = r"^state-(summary|details)-riot-game-([0-9]+)$"
+GRAPHQL_OPERATION_NAME_RE = r"^\s*query\s+(\w+)"
+
+# A series is finalized once every game has ready summary and details files and it was scheduled this long ago
+FINALIZED_SERIES_AGE = timedelta(hours=12)
+# File lists of finalized series are only requested again after this long, in case GRID reprocesses a game
+FINALIZED_SERIES_RECHECK_INTERVAL = timedelta(hours=6)
 
 GRAPHQL_TOURNAMENT_FIELDS_STRING = """
 id
@@ -66,12 +81,21 @@ tournament {{
 """
 
 
+def _record_backoff(details: dict) -> None:
+    details["args"][0].stats.incr("retries")
+
+
 class GridAPIWrapper:
-    def __init__(self, bot: Red, session: ClientSession):
+    def __init__(self, bot: Red, session: ClientSession, stats: Optional[StatsCollector] = None):
         self.bot = bot
         self.session = session
+        self.stats = stats or StatsCollector()
 
         self._tournament_cache = {"parent": {}, "name_to_id": {}}
+        # series_id -> (unfiltered file list, time.monotonic() of the last check)
+        self._finalized_series: dict[str, tuple[list[GridFileData], float]] = {}
+        # (method, route, body) -> [in-flight request task, number of callers that joined it]
+        self._in_flight: dict[tuple[str, str, str], list] = {}
 
         self.api_token = None
 
@@ -212,14 +236,18 @@ class GridAPIWrapper:
             if return_parent_tournaments:
                 series["tournament"] = await self.get_parent_tournament(series["tournament"]["id"])
             if return_file_list:
-                series["file_list"] = await self.get_series_file_list(series["id"])
+                series["file_list"] = await self.get_series_file_list(
+                    series["id"], start_time_scheduled=series["startTimeScheduled"]
+                )
             ret.append(series)
 
         return ret
 
     async def get_tournament_id(self, tournament_name: str) -> str:
         if tournament_name in self._tournament_cache["name_to_id"]:
+            self.stats.cache_hit("tournament_name_to_id")
             return self._tournament_cache["name_to_id"][tournament_name]
+        self.stats.cache_miss("tournament_name_to_id")
 
         tournament_id_response = await self.get_tournaments_list(tournament_name=tournament_name, limit=1)
         if not tournament_id_response:
@@ -233,7 +261,9 @@ class GridAPIWrapper:
             tournament_id = await self.get_tournament_id(tournament_name)
 
         if tournament_id in self._tournament_cache["parent"]:
+            self.stats.cache_hit("tournament_parent")
             return self._tournament_cache["parent"][tournament_id]
+        self.stats.cache_miss("tournament_parent")
 
         children = []
         while True:
@@ -437,13 +467,38 @@ class GridAPIWrapper:
             raise NotFoundException
         return series_data[0]
 
+    def _prune_finalized_series(self) -> None:
+        """Forgets the series that were last checked a recheck interval ago, e.g. because they left the polled window"""
+        now = time.monotonic()
+        expired = [series_id for series_id, (_, checked_at) in self._finalized_series.items()
+                   if now - checked_at >= FINALIZED_SERIES_RECHECK_INTERVAL.total_seconds()]
+        for series_id in expired:
+            del self._finalized_series[series_id]
+
     async def get_series_file_list(
             self,
             series_id: str,
             only_end_state_files: Optional[bool] = True,
-            filter_non_ready_files: Optional[bool] = True
+            filter_non_ready_files: Optional[bool] = True,
+            start_time_scheduled: Optional[Union[str, datetime]] = None
     ) -> list[GridFileData]:
-        response = (await self._do_api_call("GET", f"file-download/list/{series_id}"))["files"]
+        """Get the file list of a series
+
+        If start_time_scheduled is given, the file list of a series that is finalized is remembered
+        and only requested again every FINALIZED_SERIES_RECHECK_INTERVAL.
+        """
+        cached = self._finalized_series.get(series_id)
+        if cached is not None and time.monotonic() - cached[1] < FINALIZED_SERIES_RECHECK_INTERVAL.total_seconds():
+            self.stats.cache_hit("finalized_series")
+            response = cached[0]
+        else:
+            self.stats.cache_miss("finalized_series")
+            self._prune_finalized_series()
+            response = (await self._do_api_call("GET", f"file-download/list/{series_id}"))["files"]
+            if start_time_scheduled is not None and self._is_series_finalized(response, start_time_scheduled):
+                self._finalized_series[series_id] = (response, time.monotonic())
+            else:
+                self._finalized_series.pop(series_id, None)
 
         ret = []
 
@@ -457,6 +512,23 @@ class GridAPIWrapper:
 
         return ret
 
+    @staticmethod
+    def _is_series_finalized(file_list: list[GridFileData], start_time_scheduled: Union[str, datetime]) -> bool:
+        if isinstance(start_time_scheduled, str):
+            start_time_scheduled = isoparse(start_time_scheduled)
+        if datetime.now(timezone.utc) - start_time_scheduled < FINALIZED_SERIES_AGE:
+            return False
+
+        ready_files = {}
+        for file in file_list:
+            if not (match := re.match(END_STATE_FILE_ID_RE, file["id"])):
+                continue
+            game_files = ready_files.setdefault(match[2], set())
+            if file["status"] == "ready":
+                game_files.add(match[1])
+
+        return bool(ready_files) and all(game_files == {"summary", "details"} for game_files in ready_files.values())
+
     async def get_file(self, file_type: FileType, series_id: str, game_sequence: str) -> dict:
         return await self._do_api_call(
             "GET",
@@ -481,8 +553,63 @@ class GridAPIWrapper:
                 raise RateLimitException
         response.raise_for_status()
 
-    @backoff.on_exception(backoff.expo, RateLimitException, logger=None)
+    @staticmethod
+    def _get_route_key(method: str, route: str, data: Optional[dict] = None) -> str:
+        # Collapse IDs so that every series/game shares the same latency histogram
+        route = re.sub(r"/[0-9]+(?=/|$)", "/{id}", route)
+        if data and data.get("query") and (match := re.match(GRAPHQL_OPERATION_NAME_RE, data["query"])):
+            route = f"{route} {match[1]}"
+        return f"{method} {route}"
+
     async def _do_api_call(self, method: Literal['GET', 'POST'], route: str, data: Optional[dict] = None) -> dict:
+        """Do an API call, sharing a single request between identical concurrent calls"""
+        key = (method, route, json.dumps(data, sort_keys=True))
+
+        if (in_flight := self._in_flight.get(key)) is not None:
+            self.stats.incr("coalesced_requests")
+            in_flight[1] += 1
+            return copy.deepcopy(await asyncio.shield(in_flight[0]))
+
+        task = asyncio.ensure_future(self._do_retried_api_call(method, route, data))
+        in_flight = self._in_flight[key] = [task, 0]
+        task.add_done_callback(lambda t: self._forget_in_flight(key, t))
+
+        response = await asyncio.shield(task)
+        # Callers modify the responses they get, so whenever it was shared every caller gets its own copy
+        return copy.deepcopy(response) if in_flight[1] else response
+
+    def _forget_in_flight(self, key: tuple[str, str, str], task: asyncio.Future) -> None:
+        if self._in_flight.get(key, [None])[0] is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved in case every caller was cancelled while waiting
+            task.exception()
+
+    @backoff.on_exception(backoff.expo, RateLimitException, logger=logger, on_backoff=_record_backoff)
+    async def _do_retried_api_call(
+            self,
+            method: Literal['GET', 'POST'],
+            route: str,
+            data: Optional[dict] = None
+    ) -> dict:
+        route_key = self._get_route_key(method, route, data)
+        self.stats.incr("requests")
+        start = time.perf_counter()
+        try:
+            return await self._do_http_request(method, route, data)
+        except RateLimitException:
+            self.stats.incr("rate_limited")
+            raise
+        except NotFoundException:
+            self.stats.incr("not_found")
+            raise
+        except Exception:
+            self.stats.incr("errors")
+            raise
+        finally:
+            self.stats.observe_request(route_key, (time.perf_counter() - start) * 1000)
+
+    async def _do_http_request(self, method: Literal['GET', 'POST'], route: str, data: Optional[dict] = None) -> dict:
         endpoint = "https://api.grid.gg/"
 
         if method == "GET":
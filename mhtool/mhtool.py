@@ -19,14 +19,15 @@ from redbot.core.bot import Red
 from redbot.core.commands import UserInputOptional
 from redbot.core.utils.chat_formatting import box, inline, pagify, spoiler
 from tsutils.cogs.globaladmin import auth_check, has_perm
-from tsutils.helper_functions import repeating_timer
 from tsutils.user_interaction import cancellation_message, confirmation_message, get_user_confirmation, \
     send_cancellation_message
 
+from mhtool.cargo import async_query_in_chunks
 from mhtool.errors import NotFoundException
 from mhtool.converters import DateConverter
 
 from mhtool.grid_api_wrapper import GridAPIWrapper, FileType, Series, GridFileData
+from mhtool.stats import StatsCollector
 
 
 class Game(TypedDict, total=False):
@@ -40,6 +41,17 @@ class Game(TypedDict, total=False):
 
 logger = logging.getLogger('red.esports-wiki-cogs.mhtool')
 
+# Poll intervals in seconds
+POLL_INTERVAL_LIVE = 30
+POLL_INTERVAL_DEFAULT = 120
+POLL_INTERVAL_IDLE = 15 * 60
+# Wake up this many seconds before the next scheduled series
+SCHEDULED_WAKEUP_LEAD = 60
+# A series counts as live if it started less than SERIES_LIVE_WINDOW ago
+# and its file list grew (or it started) less than SERIES_QUIET_PERIOD ago
+SERIES_LIVE_WINDOW = timedelta(hours=6)
+SERIES_QUIET_PERIOD = timedelta(minutes=90)
+
 
 async def is_editor(ctx) -> bool:
     GAMHCOG = ctx.bot.get_cog("MHTool")
@@ -68,8 +80,10 @@ class MHTool(commands.Cog):
                                     invalid_games={}, grid_gte=False)
         self.config.register_user(allowed_tournaments={}, subscriptions={})
 
-        self.api = GridAPIWrapper(bot, self.session)
+        self.stats = StatsCollector()
+        self.api = GridAPIWrapper(bot, self.session, self.stats)
 
+        self._series_activity: dict[str, tuple[int, datetime]] = {}
         self._loop = bot.loop.create_task(self.do_loop())
         self.subscription_lock = asyncio.Lock()
 
@@ -95,28 +109,73 @@ class MHTool(commands.Cog):
 
     async def do_loop(self) -> NoReturn:
         try:
-            async for _ in repeating_timer(120):
+            while True:
+                self.stats.start_tick()
+                # Kept if anything below fails, the adaptive delay is only used after a successful tick
+                delay = POLL_INTERVAL_DEFAULT
                 try:
-                    series_cache = await self.api.get_series_list(
-                        limit=200,
-                        gte=(await self.config.grid_gte()) or None,
-                        # If we don't specifiy a time limit we get a lot of scheduled games which are useless
-                        # We still get some this way but less
-                        lte=(
-                                datetime.now(timezone.utc) + timedelta(hours=4)
-                        ).replace(microsecond=0).astimezone().isoformat(),
-                        return_file_list=True,
-                        return_parent_tournaments=True
-                    )
+                    with self.stats.timer("list_series"):
+                        series_cache = await self.api.get_series_list(
+                            limit=200,
+                            gte=(await self.config.grid_gte()) or None,
+                            # If we don't specifiy a time limit we get a lot of scheduled games which are useless
+                            # We still get some this way but less
+                            lte=(
+                                    datetime.now(timezone.utc) + timedelta(hours=4)
+                            ).replace(microsecond=0).astimezone().isoformat(),
+                            return_parent_tournaments=True
+                        )
+                    with self.stats.timer("file_lists"):
+                        for series in series_cache:
+                            series["file_list"] = await self.api.get_series_file_list(
+                                series["id"], start_time_scheduled=series["startTimeScheduled"]
+                            )
                     await self.do_auto_channel(series_cache)
                     await self.do_subscriptions(series_cache)
+                    self.stats.incr("ticks")
+                    delay = self.get_next_poll_delay(series_cache)
                 except asyncio.CancelledError:
                     raise
                 except Exception:
+                    self.stats.incr("tick_errors")
                     logger.exception("Error in loop:")
+                finally:
+                    self.stats.end_tick()
+                self.stats.set_gauge("poll_interval_s", delay)
+                await asyncio.sleep(delay)
         except asyncio.CancelledError:
             return
 
+    def get_next_poll_delay(self, series_cache: list[Series]) -> int:
+        """Poll quickly while series are live, otherwise sleep until shortly before the next scheduled one"""
+        now = datetime.now(timezone.utc)
+        activity = {}
+        live = False
+        next_start = None
+
+        for series in series_cache:
+            start = isoparse(series["startTimeScheduled"])
+            if start > now:
+                next_start = start if next_start is None else min(next_start, start)
+                continue
+            file_count = len(series.get("file_list", []))
+            last_count, last_activity = self._series_activity.get(series["id"], (file_count, start))
+            if file_count > last_count:
+                last_activity = now
+            activity[series["id"]] = (file_count, last_activity)
+            if now - start <= SERIES_LIVE_WINDOW and now - last_activity <= SERIES_QUIET_PERIOD:
+                live = True
+
+        # Series outside of the window are forgotten, so we don't grow forever
+        self._series_activity = activity
+
+        if live:
+            return POLL_INTERVAL_LIVE
+        if next_start is None:
+            return POLL_INTERVAL_IDLE
+        until_next = (next_start - now).total_seconds() - SCHEDULED_WAKEUP_LEAD
+        return int(min(max(until_next, POLL_INTERVAL_LIVE), POLL_INTERVAL_IDLE))
+
     @staticmethod
     async def get_changed_series(series_cache: list, seen: dict) -> list:
         return sorted(
@@ -203,26 +262,30 @@ class MHTool(commands.Cog):
 
             changed_series = await self.get_changed_series(series_cache, seen)
 
-            changed_games = await self.extract_games_from_series_list(changed_series, filt=self.filter_unseen_files,
-                                                                      seen=seen)
-                    
+            with self.stats.timer("summaries"):
+                changed_games = await self.extract_games_from_series_list(changed_series,
+                                                                          filt=self.filter_unseen_files, seen=seen)
+
             for u_id, data in (await self.config.all_users()).items():
                 if (user := self.bot.get_user(u_id)) is None:
                     logger.warning(f"Failed to find user with ID {u_id} for subscription.")
                     continue
-                msg = [
-                    await self.format_game_long(game, user) for game in changed_games if (
-                        u_id in tournaments_to_uid[game["series"]["tournament"]["name"]].union(
-                            tournaments_to_uid['ALL']
+                with self.stats.timer("formatting"):
+                    msg = [
+                        await self.format_game_long(game, user) for game in changed_games if (
+                            u_id in tournaments_to_uid[game["series"]["tournament"]["name"]].union(
+                                tournaments_to_uid['ALL']
+                            )
+                            and f"state-details-riot-game-{game['sequence']}" in game["files"]
+                            and f"state-summary-riot-game-{game['sequence']}" in game["files"]
+                            and await self.has_access(user, game["series"]["tournament"]["name"])
                         )
-                        and f"state-details-riot-game-{game['sequence']}" in game["files"]
-                        and f"state-summary-riot-game-{game['sequence']}" in game["files"]
-                        and await self.has_access(user, game["series"]["tournament"]["name"])
-                    )
-                ]
+                    ]
                 try:
-                    for page in pagify('\n\n'.join(msg)):
-                        await user.send(page)
+                    with self.stats.timer("sends"):
+                        for page in pagify('\n\n'.join(msg)):
+                            await user.send(page)
+                            self.stats.incr("messages_sent")
                 except discord.Forbidden:
                     logger.warning(f"Unable to send subscription message to user {user}. (Forbidden)")
 
@@ -233,19 +296,23 @@ class MHTool(commands.Cog):
         async with self.config.autochannel_seen() as seen:
             changed_series = await self.get_changed_series(series_cache, seen)
 
-            changed_games = await self.extract_games_from_series_list(changed_series, filt=self.filter_unseen_files,
-                                                                      seen=seen)
+            with self.stats.timer("summaries"):
+                changed_games = await self.extract_games_from_series_list(changed_series,
+                                                                          filt=self.filter_unseen_files, seen=seen)
 
-            msg = [
-                await self.format_game_long(game, None) for game in
-                changed_games if f"state-details-riot-game-{game['sequence']}" in game["files"]
-                and f"state-summary-riot-game-{game['sequence']}" in game["files"]
-            ]
+            with self.stats.timer("formatting"):
+                msg = [
+                    await self.format_game_long(game, None) for game in
+                    changed_games if f"state-details-riot-game-{game['sequence']}" in game["files"]
+                    and f"state-summary-riot-game-{game['sequence']}" in game["files"]
+                ]
 
-            for cid in await self.config.auto_channels():
-                if None is not (channel := self.bot.get_channel(int(cid))):
-                    for page in pagify('\n\n'.join(msg)):
-                        await channel.send(page)
+            with self.stats.timer("sends"):
+                for cid in await self.config.auto_channels():
+                    if None is not (channel := self.bot.get_channel(int(cid))):
+                        for page in pagify('\n\n'.join(msg)):
+                            await channel.send(page)
+                            self.stats.incr("messages_sent")
 
             for game in changed_games:
                 await self.append_new_files_to_seen(seen, game)
@@ -740,6 +807,25 @@ class MHTool(commands.Cog):
         await self.config.grid_gte.set(str(date.strip()))
         await ctx.tick()
 
+    @mhtool.group(name='stats', invoke_without_command=True)
+    @auth_check('mhadmin')
+    async def mh_stats(self, ctx):
+        """Show request, cache and poll loop statistics"""
+        for page in pagify(self.stats.format_summary()):
+            await ctx.send(box(page))
+
+    @mh_stats.command(name='json', aliases=['export'])
+    async def mh_st_json(self, ctx):
+        """Export the current statistics as a JSON file"""
+        await ctx.send(file=discord.File(BytesIO(json.dumps(self.stats.to_dict(), indent=2).encode("utf-8")),
+                                         'mhtool_stats.json'))
+
+    @mh_stats.command(name='reset')
+    async def mh_st_reset(self, ctx):
+        """Reset all statistics"""
+        self.stats.reset()
+        await ctx.tick()
+
     async def format_game_long(self, game: Game, user: Optional[User]) -> str:
         tournament = game["series"]["tournament"]["name"]
 
@@ -801,12 +887,12 @@ class MHTool(commands.Cog):
         if not games:
             return []
 
-        all_ids = [repr(game['platform_game_id'].strip()) for game in games]
-        where = f"RiotPlatformGameId IN ({','.join(all_ids)}) AND HasRpgidInput = '1'"
+        all_ids = [game['platform_game_id'].strip() for game in games]
 
-        result = site.cargo_client.query(tables="MatchScheduleGame",
-                                         fields="RiotPlatformGameId",
-                                         where=where)
+        result = await async_query_in_chunks(site, "RiotPlatformGameId", all_ids,
+                                             where="HasRpgidInput = '1'",
+                                             tables="MatchScheduleGame",
+                                             fields="RiotPlatformGameId")
 
         old_ids = [row['RiotPlatformGameId'] for row in result]
         return [game for game in games if game['platform_game_id'] not in old_ids]
@@ -0,0 +1,144 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+# Upper bounds (in milliseconds) of the latency histogram buckets, the last bucket catches everything above
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def observe(self, ms: float) -> None:
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def to_dict(self) -> dict:
+        labels = [f"<={bound}ms" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+        return {
+            "count": self.count,
+            "mean_ms": round(self.mean, 1),
+            "max_ms": round(self.max, 1),
+            "total_ms": round(self.total, 1),
+            "buckets": dict(zip(labels, self.buckets)),
+        }
+
+
+class StatsCollector:
+    """Collects request, cache and poll loop metrics for MHTool
+
+    Everything is kept in memory and reset when the cog is reloaded.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.counters: dict[str, int] = defaultdict(int)
+        self.gauges: dict[str, float] = {}
+        self.route_latencies: dict[str, LatencyHistogram] = defaultdict(LatencyHistogram)
+        self.caches: dict[str, dict[str, int]] = defaultdict(lambda: {"hits": 0, "misses": 0})
+        self.phases: dict[str, LatencyHistogram] = defaultdict(LatencyHistogram)
+        self.ticks = LatencyHistogram()
+        self.last_tick: dict[str, float] = {}
+        self._current_tick: Optional[dict[str, float]] = None
+        self._tick_started_at: Optional[float] = None
+
+    def reset(self) -> None:
+        self.__init__()
+
+    def incr(self, counter: str, amount: int = 1) -> None:
+        self.counters[counter] += amount
+
+    def set_gauge(self, gauge: str, value: float) -> None:
+        self.gauges[gauge] = value
+
+    def observe_request(self, route: str, ms: float) -> None:
+        self.route_latencies[route].observe(ms)
+
+    def cache_hit(self, cache: str) -> None:
+        self.caches[cache]["hits"] += 1
+
+    def cache_miss(self, cache: str) -> None:
+        self.caches[cache]["misses"] += 1
+
+    def start_tick(self) -> None:
+        self._current_tick = defaultdict(float)
+        self._tick_started_at = time.perf_counter()
+
+    def end_tick(self) -> None:
+        if self._current_tick is None:
+            return
+        total = (time.perf_counter() - self._tick_started_at) * 1000
+        self.ticks.observe(total)
+        self.last_tick = {**self._current_tick, "total": total}
+        self._current_tick = None
+        self._tick_started_at = None
+
+    @contextmanager
+    def timer(self, phase: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            ms = (time.perf_counter() - start) * 1000
+            self.phases[phase].observe(ms)
+            if self._current_tick is not None:
+                self._current_tick[phase] += ms
+
+    def to_dict(self) -> dict:
+        return {
+            "started_at": self.started_at,
+            "uptime_s": round(time.time() - self.started_at),
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "routes": {route: hist.to_dict() for route, hist in sorted(self.route_latencies.items())},
+            "caches": {
+                name: {**data, "hit_rate": round(data["hits"] / (data["hits"] + data["misses"]), 3)
+                       if data["hits"] + data["misses"] else None}
+                for name, data in sorted(self.caches.items())
+            },
+            "ticks": self.ticks.to_dict(),
+            "last_tick_ms": {phase: round(ms, 1) for phase, ms in self.last_tick.items()},
+            "phases": {phase: hist.to_dict() for phase, hist in sorted(self.phases.items())},
+        }
+
+    def format_summary(self) -> str:
+        data = self.to_dict()
+        lines = [f"Uptime: {data['uptime_s']}s"]
+
+        lines.append("\nCounters:")
+        for counter, value in sorted(data["counters"].items()):
+            lines.append(f"  {counter}: {value}")
+
+        lines.append("\nGauges:")
+        for gauge, value in sorted(data["gauges"].items()):
+            lines.append(f"  {gauge}: {value}")
+
+        lines.append("\nRoutes (count / mean / max):")
+        for route, hist in data["routes"].items():
+            lines.append(f"  {route}: {hist['count']} / {hist['mean_ms']}ms / {hist['max_ms']}ms")
+
+        lines.append("\nCaches (hits / misses / hit rate):")
+        for cache, cdata in data["caches"].items():
+            lines.append(f"  {cache}: {cdata['hits']} / {cdata['misses']} / {cdata['hit_rate']}")
+
+        lines.append(f"\nTicks: {data['ticks']['count']}, mean {data['ticks']['mean_ms']}ms,"
+                     f" max {data['ticks']['max_ms']}ms")
+        lines.append("Last tick:")
+        for phase, ms in data["last_tick_ms"].items():
+            lines.append(f"  {phase}: {ms}ms")
+        return '\n'.join(lines)
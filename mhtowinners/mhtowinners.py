@@ -1,11 +1,14 @@
 from esports_cog_utils.utils import get_credentials
 from mwrogue.esports_client import EsportsClient
 from requests import ReadTimeout
-from redbot.core import commands, app_commands
+from redbot.core import commands, app_commands, Config
+from redbot.core.data_manager import cog_data_path
+from redbot.core.utils.chat_formatting import box, text_to_file
 from tsutils.user_interaction import StatusManager
 
 from mhtowinners.sbtowinners_main import SbToWinnersRunner
 from mhtowinners.mhtowinners_main import MhToWinnersRunner
+from mhtowinners.vodstosb_main import VOD_PARAMS, VodsToSbRunner
 
 
 class MhToWinners(commands.Cog):
@@ -14,6 +17,14 @@ class MhToWinners(commands.Cog):
     def __init__(self, bot, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.bot = bot
+        self.config = Config.get_conf(self, identifier=1701)
+        default_global = {
+            "vodstosb_high_water_marks": {}
+        }
+        self.config.register_global(**default_global)
+
+    def get_cache_file(self):
+        return str(cog_data_path(self) / "mh_games.json")
 
     @commands.hybrid_command(name="sbtowinners", pass_context=True)
     @app_commands.describe(title_list="A comma separated list of tournament overview pages to update")
@@ -22,14 +33,62 @@ class MhToWinners(commands.Cog):
         title_list = [title.strip() for title in title_list.split(",")]
         await self._do_the_thing(ctx, SbToWinnersRunner, title_list)
 
+    @commands.hybrid_command(name="sbtowinnersdry", pass_context=True)
+    @app_commands.describe(title_list="A comma separated list of tournament overview pages to check")
+    async def sbtowinnersdry(self, ctx, *, title_list: str = ""):
+        """Shows what sbtowinners would change, without saving anything"""
+        title_list = [title.strip() for title in title_list.split(",")]
+        await self._do_the_thing(ctx, SbToWinnersRunner, title_list, dry_run=True)
+
     @commands.hybrid_command(name="mhtowinners", pass_context=True)
     @app_commands.describe(title_list="A comma separated list of tournament overview pages to update")
     async def mhtowinners(self, ctx, *, title_list: str):
         """Updates MatchSchedule using match history data"""
         title_list = [title.strip() for title in title_list.split(",")]
-        await self._do_the_thing(ctx, MhToWinnersRunner, title_list)
+        await self._do_the_thing(ctx, MhToWinnersRunner, title_list, cache_file=self.get_cache_file())
+
+    @commands.hybrid_command(name="mhtowinnersdry", pass_context=True)
+    @app_commands.describe(title_list="A comma separated list of tournament overview pages to check")
+    async def mhtowinnersdry(self, ctx, *, title_list: str):
+        """Shows what mhtowinners would change, without saving anything"""
+        title_list = [title.strip() for title in title_list.split(",")]
+        await self._do_the_thing(ctx, MhToWinnersRunner, title_list, cache_file=self.get_cache_file(), dry_run=True)
+
+    @commands.hybrid_command(name="mhtowinnersreset", pass_context=True)
+    async def mhtowinnersreset(self, ctx):
+        """Forgets the stored match history results, so that every game is downloaded again"""
+        if MhToWinnersRunner.clear_cache(self.get_cache_file()):
+            return await ctx.send("Okay, the stored match history results have been cleared!")
+        await ctx.send("There are no stored match history results.")
+
+    @commands.hybrid_command(name="vodstosb", pass_context=True)
+    @app_commands.describe(title_list="A comma separated list of tournament overview pages, leave empty for all")
+    async def vodstosb(self, ctx, *, title_list: str = ""):
+        """Copies VODs from MatchSchedule to the scoreboards"""
+        await self._run_vodstosb(ctx, title_list)
+
+    @commands.hybrid_command(name="vodstosbincremental", pass_context=True)
+    @app_commands.describe(title_list="A comma separated list of tournament overview pages, leave empty for all")
+    async def vodstosbincremental(self, ctx, *, title_list: str = ""):
+        """Copies VODs from MatchSchedule to the scoreboards, only checking games changed since the last run"""
+        await self._run_vodstosb(ctx, title_list, incremental=True)
+
+    @commands.hybrid_command(name="vodstosbdry", pass_context=True)
+    @app_commands.describe(title_list="A comma separated list of tournament overview pages, leave empty for all")
+    async def vodstosbdry(self, ctx, *, title_list: str = ""):
+        """Shows what vodstosb would change, without saving anything"""
+        await self._run_vodstosb(ctx, title_list, dry_run=True)
+
+    async def _run_vodstosb(self, ctx, title_list: str, incremental: bool = False, dry_run: bool = False):
+        title_list = [title.strip() for title in title_list.split(",")]
+        high_water_marks = await self.config.vodstosb_high_water_marks()
+        runner = await self._do_the_thing(ctx, VodsToSbRunner, VOD_PARAMS, title_list,
+                                          high_water_marks=high_water_marks, incremental=incremental,
+                                          dry_run=dry_run)
+        if runner is not None and not dry_run:
+            await self.config.vodstosb_high_water_marks.set(high_water_marks)
 
-    async def _do_the_thing(self, ctx, the_thing, *args):
+    async def _do_the_thing(self, ctx, the_thing, *args, **kwargs):
         await ctx.send('Okay, starting now!')
         credentials = await get_credentials(ctx, self.bot)
         site = EsportsClient('lol', credentials=credentials,
@@ -37,7 +96,16 @@ class MhToWinners(commands.Cog):
                              max_retries=2, retry_interval=10)
         try:
             async with StatusManager(self.bot):
-                the_thing(site, *args).run()
+                runner = the_thing(site, *args, **kwargs)
+                runner.run()
         except ReadTimeout:
-            return await ctx.send('Whoops, the site is taking too long to respond, try again later')
-        await ctx.send('Okay, done!')
+            await ctx.send('Whoops, the site is taking too long to respond, try again later')
+            return None
+        if not runner.dry_run:
+            await ctx.send('Okay, done!')
+            return runner
+        await ctx.send(f"Okay, done! {len(runner.diffs)} page(s) would be edited.\n"
+                       f"{box(runner.timer.format_summary())}")
+        if runner.diffs:
+            await ctx.send(file=text_to_file('\n\n'.join(runner.diffs.values()), filename="changes.diff"))
+        return runner
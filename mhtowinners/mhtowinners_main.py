@@ -1,10 +1,26 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Union
+
 import mwparserfromhell
-from mwcleric.errors import RetriedLoginAndStillFailed
 from mwrogue.esports_client import EsportsClient
 from lol_dto.classes.game import LolGameTeam
 
 import riot_transmute
 from bayes_lol_client import BayesEMH
+from bayes_lol_client.errors import NotFoundError
+
+from mhtowinners.pages import PageSaveQueue, get_pages_with_text
+from mhtowinners.storage import read_json, remove_file, write_json
+from mhtowinners.timing import PhaseTimer
+
+# Number of games downloaded from the match history at the same time
+MH_FETCH_MAX_WORKERS = 8
+
+# Games that could not be resolved from the match history are not requested again for this many seconds
+FAILED_GAME_RETRY_AFTER = 6 * 60 * 60
+# Resolved games are forgotten once they weren't needed for this many seconds, by then their rows are filled in
+RESOLVED_GAME_KEEP_FOR = 30 * 24 * 60 * 60
 
 
 def tl_has(tl, param):
@@ -12,34 +28,95 @@ def tl_has(tl, param):
 
 
 class MhToWinnersRunner(object):
-    def __init__(self, site: EsportsClient, title_list: list):
+    # Bump whenever the format of the cached results changes, older caches are then ignored
+    CACHE_VERSION = 2
+
+    def __init__(self, site: EsportsClient, title_list: list, summary_only: bool = True,
+                 cache_file: Optional[str] = None, dry_run: bool = False):
         self.site = site
+        self.dry_run = dry_run
+        self.timer = PhaseTimer()
+        self.diffs = {}
+        self.summary_only = summary_only
+        self.cache_file = cache_file
+        self.resolved_games = {}
+        self.failed_games = {}
         self.summary = 'Discover sides & winners from the MH & populate in the row'
         self.emh = BayesEMH()
         self.title_list = [f'"{self.site.cache.get_target(title)}"' for title in title_list]
 
     def run(self):
-        pages_to_edit = self.site.cargo_client.query(
-            tables="MatchSchedule=MS",
-            fields="MS._pageName=Page, MS.OverviewPage",
-            where=f"MS.OverviewPage IN ({','.join(self.title_list)})",
-            group_by="MS._pageName"
-        )
-        self.update_pages(pages_to_edit)
-    
+        # Only pages with at least one game that has a platform game id and is missing its sides or winner
+        with self.timer.time("query"):
+            pages_to_edit = self.site.cargo_client.query(
+                tables="MatchScheduleGame=MSG",
+                fields="MSG._pageName=Page, MSG.OverviewPage",
+                where=(f"MSG.OverviewPage IN ({','.join(self.title_list)})"
+                       " AND MSG.RiotPlatformGameId IS NOT NULL"
+                       " AND (MSG.Blue IS NULL OR MSG.Red IS NULL OR MSG.Winner IS NULL)"),
+                group_by="MSG._pageName"
+            )
+        self.load_cache()
+        try:
+            self.update_pages(pages_to_edit)
+        finally:
+            self.save_cache()
+
+    def load_cache(self):
+        """Loads the match history results that were resolved or failed in previous runs"""
+        if self.cache_file is None:
+            return
+        cache = read_json(self.cache_file)
+        # A missing or unreadable cache only means that every pending game is requested again
+        if not isinstance(cache, dict) or cache.get("version") != self.CACHE_VERSION:
+            return
+        now = time.time()
+        self.resolved_games = {game_id: resolved for game_id, resolved in cache["resolved"].items()
+                               if resolved["used_at"] + RESOLVED_GAME_KEEP_FOR > now}
+        self.failed_games = {game_id: retry_after for game_id, retry_after in cache["failed"].items()
+                             if retry_after > now}
+
+    def save_cache(self):
+        if self.cache_file is None:
+            return
+        cache = {
+            "version": self.CACHE_VERSION,
+            # Sides and winner of a game in the match history never change once it's there
+            "resolved": self.resolved_games,
+            "failed": self.failed_games,
+        }
+        write_json(self.cache_file, cache)
+
+    @staticmethod
+    def clear_cache(cache_file):
+        return remove_file(cache_file)
+
     def update_pages(self, pages_to_edit):
-        for item in pages_to_edit:
-            page = self.site.client.pages[item['Page']]
-            text = page.text()
-            wikitext = mwparserfromhell.parse(text)
-            self.update_wikitext(wikitext, item['OverviewPage'])
-            self.site.report_all_errors('mhtowinners')
-            new_text = str(wikitext)
-            if new_text != text:
-                try:
-                    self.site.save(page, new_text, summary=self.summary)
-                except RetriedLoginAndStillFailed:
-                    pass
+        with self.timer.time("fetch"):
+            page_texts = get_pages_with_text(self.site, [item['Page'] for item in pages_to_edit])
+        pages = []
+        with self.timer.time("parse"):
+            for item in pages_to_edit:
+                page, text = page_texts[item['Page']]
+                pages.append((page, text, mwparserfromhell.parse(text), item['OverviewPage']))
+
+        with self.timer.time("match_history"):
+            pending_ids = [game_id for _, _, wikitext, _ in pages for game_id in self.get_pending_game_ids(wikitext)]
+            games = self.fetch_games(pending_ids)
+
+        # Each page is saved in the background while the next one is being updated
+        with PageSaveQueue(self.site, self.summary, dry_run=self.dry_run) as save_queue:
+            for page, text, wikitext, overview_page in pages:
+                # Team lookups and error reports use the site, which an edit may be logging in again with
+                with self.timer.time("modify"), save_queue.client_lock:
+                    self.update_wikitext(wikitext, overview_page, games)
+                    new_text = str(wikitext)
+                if not self.dry_run:
+                    with save_queue.client_lock:
+                        self.site.report_all_errors('mhtowinners')
+                if new_text != text:
+                    save_queue.put(page, new_text, text)
+        self.diffs = save_queue.diffs
 
     @staticmethod
     def get_team_tricode(team: LolGameTeam):
@@ -47,8 +124,9 @@ class MhToWinnersRunner(object):
             if " " in player.inGameName:
                 return player.inGameName.split(" ")[0]
         return None
-    
-    def update_wikitext(self, wikitext, overview_page: str):
+
+    @staticmethod
+    def get_pending_templates(wikitext):
         for template in wikitext.filter_templates():
             if not template.name.matches('MatchSchedule/Game'):
                 continue
@@ -56,21 +134,94 @@ class MhToWinnersRunner(object):
                 continue
             if tl_has(template, 'blue') and tl_has(template, 'red') and tl_has(template, 'winner'):
                 continue
+            yield template
+
+    def get_pending_game_ids(self, wikitext):
+        return [template.get('riot_platform_game_id').value.strip()
+                for template in self.get_pending_templates(wikitext)]
+
+    def get_game_result(self, game) -> tuple:
+        return self.get_team_tricode(game.teams.BLUE), self.get_team_tricode(game.teams.RED), game.winner
+
+    def fetch_game(self, platform_game_id: str) -> Union[tuple, Exception]:
+        """Returns the blue tricode, red tricode & winning side of a game, or the exception raised while fetching it
+
+        Sides and winner are all in the summary, so the timeline is only downloaded when the summary alone
+        can't be converted or doesn't give both tricodes.
+        """
+        if self.summary_only:
+            try:
+                summary = self.emh.get_game_summary(platform_game_id)
+            except Exception as e:
+                return e
+            try:
+                result = self.get_game_result(riot_transmute.v5.match_to_game(summary))
+                if result[0] and result[1]:
+                    return result
+            except Exception:
+                pass
+        return self.fetch_game_with_timeline(platform_game_id)
+
+    def fetch_game_with_timeline(self, platform_game_id: str) -> Union[tuple, Exception]:
+        try:
+            summary, details = self.emh.get_game_data(platform_game_id)
+            game_dto_summary = riot_transmute.v5.match_to_game(summary)
+            game_dto_details = riot_transmute.v5.match_timeline_to_game(details)
+            game = riot_transmute.merge_games_from_riot_match_and_timeline(
+                game_dto_summary, game_dto_details
+            )
+        except Exception as e:
+            return e
+        return self.get_game_result(game)
+
+    def fetch_games(self, platform_game_ids: list) -> dict:
+        """Downloads every given game from the match history concurrently, keyed by platform game id
+
+        Errors are returned instead of raised so that they can be logged against the right overview page.
+        Games resolved in a previous run are taken from the cache, and games that recently failed are left out.
+        """
+        now = time.time()
+        games = {}
+        to_fetch = []
+        for platform_game_id in dict.fromkeys(platform_game_ids):
+            if platform_game_id in self.resolved_games:
+                resolved = self.resolved_games[platform_game_id]
+                resolved["used_at"] = now
+                games[platform_game_id] = tuple(resolved["game"])
+            elif self.failed_games.get(platform_game_id, 0) <= now:
+                to_fetch.append(platform_game_id)
+        if not to_fetch:
+            return games
+
+        # The client stores its tokens without any locking, so log in before the workers start sharing it
+        self.emh.api.ensure_login()
+        with ThreadPoolExecutor(max_workers=min(MH_FETCH_MAX_WORKERS, len(to_fetch))) as executor:
+            fetched = dict(zip(to_fetch, executor.map(self.fetch_game, to_fetch)))
+
+        for platform_game_id, game in fetched.items():
+            if isinstance(game, tuple) and game[0] and game[1]:
+                self.resolved_games[platform_game_id] = {"game": list(game), "used_at": now}
+                self.failed_games.pop(platform_game_id, None)
+            elif isinstance(game, tuple) or isinstance(game, NotFoundError):
+                # Other errors may be temporary, so those games are retried on the next run
+                self.failed_games[platform_game_id] = now + FAILED_GAME_RETRY_AFTER
+        games.update(fetched)
+        return games
+
+    def update_wikitext(self, wikitext, overview_page: str, games: Optional[dict] = None):
+        if games is None:
+            games = self.fetch_games(self.get_pending_game_ids(wikitext))
+        for template in self.get_pending_templates(wikitext):
             platform_game_id = (
                 template.get('riot_platform_game_id').value.strip()
             )
-            try:
-                summary, details = self.emh.get_game_data(platform_game_id)
-                game_dto_summary = riot_transmute.v5.match_to_game(summary)
-                game_dto_details = riot_transmute.v5.match_timeline_to_game(details)
-                game = riot_transmute.merge_games_from_riot_match_and_timeline(
-                    game_dto_summary, game_dto_details
-                )
-            except Exception as e:
-                self.site.log_error_script(overview_page, e)
+            game = games.get(platform_game_id)
+            if game is None:
+                continue
+            if isinstance(game, Exception):
+                self.site.log_error_script(overview_page, game)
                 continue
-            blue = self.get_team_tricode(game.teams.BLUE)
-            red = self.get_team_tricode(game.teams.RED)
+            blue, red, winner = game
             if not blue or not red:
                 continue
             blue_team = self.site.cache.get_team_from_event_tricode(overview_page, blue)
@@ -80,7 +231,7 @@ class MhToWinnersRunner(object):
             if blue_team is not None and red_team is not None:
                 template.add('blue', blue_team)
                 template.add('red', red_team)
-                if game.winner == "BLUE":
+                if winner == "BLUE":
                     template.add('winner', "1")
-                elif game.winner == "RED":
+                elif winner == "RED":
                     template.add('winner', "2")
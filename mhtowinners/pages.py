@@ -0,0 +1,195 @@
+import difflib
+import queue
+import threading
+import time
+from contextlib import nullcontext
+from typing import Any, Callable, ContextManager, Iterable, Iterator, Optional
+
+import mwparserfromhell
+from mwparserfromhell.wikicode import Wikicode
+from mwcleric.errors import RetriedLoginAndStillFailed
+from mwclient.page import Page
+from mwclient.util import parse_timestamp
+from mwrogue.esports_client import EsportsClient
+
+from mhtowinners.timing import PhaseTimer
+
+# Maximum number of titles the API accepts in a single query for non-bot accounts
+PAGE_BATCH_SIZE = 50
+# Edits that can wait to be saved while the next pages are prepared
+SAVE_QUEUE_SIZE = 10
+# Minimum number of seconds between two edits, to stay within the wiki's edit rate limits
+SAVE_MIN_INTERVAL = 1.0
+
+
+def iter_pages_with_text(site: EsportsClient, titles: Iterable[str], batch_size: int = PAGE_BATCH_SIZE,
+                         client_lock: Optional[ContextManager] = None) -> Iterator[tuple[str, Page, str]]:
+    """Loads pages and their current wikitext, batch_size titles per request, yielding (requested title, page, text)
+
+    Pages are yielded in the order of the given titles, one batch at a time, so that the pages of a batch can be
+    processed before the next batch is requested. The returned pages keep the timestamp of the loaded revision,
+    so edit conflicts are detected when saving them exactly like after a page.text() call.
+    Missing pages have an empty text.
+    Every request is made while holding client_lock, see PageSaveQueue.client_lock.
+    """
+    client_lock = client_lock or nullcontext()
+    titles = list(dict.fromkeys(title for title in titles if title))
+    for i in range(0, len(titles), batch_size):
+        batch = titles[i:i + batch_size]
+        params = {
+            "prop": "info|revisions",
+            "inprop": "protection",
+            "rvprop": "content|timestamp",
+            "rvslots": "main",
+            "titles": "|".join(batch),
+        }
+        loaded = {}
+        continue_params = {}
+        while True:
+            with client_lock:
+                response = site.client.get("query", **params, **continue_params)
+            query = response["query"]
+            requested_titles = {item["to"]: item["from"] for item in query.get("normalized", [])}
+            for info in query["pages"].values():
+                title = requested_titles.get(info["title"], info["title"])
+                revisions = info.get("revisions")
+                if title in loaded or ("missing" not in info and not revisions):
+                    # Revisions that didn't fit in this response come with a later continuation
+                    continue
+                page = Page(site.client, info["title"], info=info)
+                text = ""
+                if revisions:
+                    text = revisions[0]["slots"]["main"]["*"]
+                    page.last_rev_time = parse_timestamp(revisions[0]["timestamp"])
+                page.edit_time = time.gmtime()
+                loaded[title] = (page, text)
+            if "continue" not in response:
+                break
+            continue_params = response["continue"]
+        for title in batch:
+            if title in loaded:
+                yield (title, *loaded[title])
+
+
+def get_pages_with_text(site: EsportsClient, titles: Iterable[str], batch_size: int = PAGE_BATCH_SIZE,
+                        client_lock: Optional[ContextManager] = None) -> dict[str, tuple[Page, str]]:
+    """Same as iter_pages_with_text, but loads every page at once, keyed by the requested title"""
+    return {title: (page, text) for title, page, text in iter_pages_with_text(site, titles, batch_size, client_lock)}
+
+
+class PageSaveQueue:
+    """Saves pages on a background thread, so that the next pages can be prepared while an edit is in flight
+
+    At most max_pending edits wait in the queue, put() blocks once it is full, and consecutive edits
+    are at least min_interval seconds apart. Edits that fail even after logging in again are skipped,
+    any other error stops the queue and is raised again by put() or close().
+    Use it as a context manager so that every queued edit is done before leaving the block.
+
+    In dry run mode nothing is saved, a unified diff of every edit is kept in diffs instead, keyed by page name.
+
+    An edit that fails because the session expired logs in again, which replaces site.client and
+    site.cargo_client. Every use of the site from another thread while the queue is open must hold client_lock,
+    so that it never runs in the middle of an edit and always sees the new client afterwards.
+    """
+
+    def __init__(self, site: EsportsClient, summary: str, max_pending: int = SAVE_QUEUE_SIZE,
+                 min_interval: float = SAVE_MIN_INTERVAL, dry_run: bool = False):
+        self.site = site
+        self.summary = summary
+        self.min_interval = min_interval
+        self.dry_run = dry_run
+        self.saved = 0
+        self.failed = 0
+        self.diffs: dict[str, str] = {}
+        self.client_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error: Optional[BaseException] = None
+        self._error_raised = False
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        if not dry_run:
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _worker(self):
+        last_save = 0.0
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                # Drain whatever was queued before the error was noticed
+                continue
+            page, text = item
+            time.sleep(max(0.0, last_save + self.min_interval - time.monotonic()))
+            with self.client_lock:
+                client = self.site.client
+                try:
+                    self.site.save(page, text, summary=self.summary)
+                    self.saved += 1
+                except RetriedLoginAndStillFailed:
+                    self.failed += 1
+                except BaseException as e:
+                    self._error = e
+                if self.site.client is not client:
+                    self._rebind_lookup_cache()
+            last_save = time.monotonic()
+
+    def _rebind_lookup_cache(self):
+        # Logging in again replaces site.client and site.cargo_client, but the lookup cache keeps its own references
+        self.site.cache.site = self.site.client
+        self.site.cache.cargo_client = self.site.cargo_client
+
+    def _raise_error(self):
+        if self._error is not None and not self._error_raised:
+            self._error_raised = True
+            raise self._error
+
+    def put(self, page: Page, text: str, old_text: str = "") -> None:
+        if self.dry_run:
+            self.diffs[page.name] = "\n".join(difflib.unified_diff(
+                old_text.splitlines(), text.splitlines(), fromfile=page.name, tofile=page.name, lineterm=""
+            ))
+            return
+        self._raise_error()
+        self._queue.put((page, text))
+
+    def close(self) -> None:
+        """Waits for every queued edit to be saved"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+
+def update_pages_from_rows(site: EsportsClient, rows: Iterable[dict], page_field: str,
+                           index: Callable[[Wikicode], Any],
+                           apply: Callable[[Any, list[dict]], None], summary: str,
+                           timer: Optional[PhaseTimer] = None, dry_run: bool = False) -> PageSaveQueue:
+    """Applies Cargo rows to the pages named by their page_field, saving every page whose text changed
+
+    Pages are loaded in batches and updated while the previous ones are being saved. For every page, index is
+    called once with its parsed wikitext, and apply is called with what index returned and the rows of the page,
+    modifying the wikitext in place. Returns the closed save queue, for its counters and diffs.
+    """
+    timer = timer or PhaseTimer()
+    rows_by_page = {}
+    for row in rows:
+        rows_by_page.setdefault(row[page_field], []).append(row)
+
+    with PageSaveQueue(site, summary, dry_run=dry_run) as save_queue:
+        pages = iter_pages_with_text(site, rows_by_page, client_lock=save_queue.client_lock)
+        for page_name, page, old_text in timer.iter("fetch", pages):
+            with timer.time("parse"):
+                wikitext = mwparserfromhell.parse(old_text)
+                indexed = index(wikitext)
+            with timer.time("modify"):
+                apply(indexed, rows_by_page[page_name])
+                new_text = str(wikitext)
+            if new_text != old_text:
+                save_queue.put(page, new_text, old_text)
+    return save_queue
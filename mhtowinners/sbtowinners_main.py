@@ -1,14 +1,18 @@
-import mwparserfromhell
-from mwcleric.errors import RetriedLoginAndStillFailed
 from mwrogue.auth_credentials import AuthCredentials
 from mwrogue.esports_client import EsportsClient
 
+from mhtowinners.pages import update_pages_from_rows
+from mhtowinners.timing import PhaseTimer
+
 
 class SbToWinnersRunner:
     summary = "Discover sides & winners from the SB & populate in the row"
 
-    def __init__(self, site: EsportsClient, title_list):
+    def __init__(self, site: EsportsClient, title_list, dry_run: bool = False):
         self.site = site
+        self.dry_run = dry_run
+        self.timer = PhaseTimer()
+        self.diffs = {}
         self.events_to_skip = []
         if title_list != [""]:
             self.title_list = [f"\"{site.cache.get_target(title)}\"" for title in title_list]
@@ -21,10 +25,17 @@ class SbToWinnersRunner:
                 f"AND MSG.OverviewPage NOT IN ({','.join(self.events_to_skip)}) "
         if self.title_list:
             where += f"AND MSG.OverviewPage IN ({','.join(self.title_list)})"
-        print(where)
         return where
 
     def run(self):
+        with self.timer.time("query"):
+            result = self.query()
+
+        save_queue = update_pages_from_rows(self.site, result, 'DataPage', self.index_game_templates,
+                                            self.update_templates, self.summary, self.timer, self.dry_run)
+        self.diffs = save_queue.diffs
+
+    def query(self):
         result = self.site.cargo_client.query(
             tables="TournamentScriptsToSkip",
             fields="OverviewPage",
@@ -44,7 +55,7 @@ class SbToWinnersRunner:
             "MSG.N_GameInMatch",
             "MSG._pageName=DataPage",
         ]
-        result = self.site.cargo_client.query(
+        return self.site.cargo_client.query(
             tables="ScoreboardGames=SG, MatchScheduleGame=MSG",
             fields=fields,
             join_on="MSG.GameId=SG.GameId",
@@ -52,58 +63,38 @@ class SbToWinnersRunner:
             order_by='MSG._pageName'
         )
 
-        current_page = {
-            'page': None,
-            'wikitext': None,
-            'page_name': None,
-            'old_text': None,
-        }
+    @staticmethod
+    def index_game_templates(wikitext):
+        """Returns the MatchSchedule/Game templates of a data page keyed by (tab, match, game) position"""
+        templates = {}
+        tab_counter = 0
+        match_counter = 0
+        game_counter = 0
+        for template in wikitext.filter_templates():
+            if template.name.matches("MatchSchedule/Start"):
+                tab_counter += 1
+                match_counter = 0
+            elif template.name.matches("MatchSchedule"):
+                match_counter += 1
+                game_counter = 0
+            elif template.name.matches("MatchSchedule/Game"):
+                game_counter += 1
+                templates.setdefault((tab_counter, match_counter, game_counter), []).append(template)
+        return templates
 
-        for item in result:
+    @staticmethod
+    def update_templates(templates, rows):
+        for item in rows:
             tab_target = int(item['N TabInPage'])
             match_target = int(item['N MatchInTab'])
             game_target = int(item['N GameInMatch'])
-
-            if current_page['page_name'] != item['DataPage']:
-                if current_page['page'] is not None:
-                    self.save_page(current_page)
-                current_page['page_name'] = item['DataPage']
-                current_page['page'] = self.site.client.pages[current_page['page_name']]
-                old_text = current_page['page'].text()
-                current_page['old_text'] = old_text
-                current_page['wikitext'] = mwparserfromhell.parse(old_text)
-
-            tab_counter = 0
-            match_counter = 0
-            game_counter = 0
-            for template in current_page['wikitext'].filter_templates():
-                if template.name.matches("MatchSchedule/Start"):
-                    tab_counter += 1
-                    match_counter = 0
-                elif template.name.matches("MatchSchedule"):
-                    match_counter += 1
-                    game_counter = 0
-                elif template.name.matches("MatchSchedule/Game"):
-                    game_counter += 1
-                    if (tab_counter, match_counter, game_counter) == (tab_target, match_target, game_target):
-                        if not template.has("blue", ignore_empty=True):
-                            template.add("blue", item['Team1'])
-                        if not template.has("red", ignore_empty=True):
-                            template.add("red", item['Team2'])
-                        if not template.has("winner", ignore_empty=True):
-                            template.add("winner", item['WinTeam'])
-
-        # we need to catch the last iteration too (assuming we actually did anything)
-        if current_page['page'] is not None:
-            self.save_page(current_page)
-
-    def save_page(self, page_dict):
-        new_text = str(page_dict['wikitext'])
-        if new_text != page_dict['old_text']:
-            try:
-                self.site.save(page_dict['page'], new_text, summary=self.summary)
-            except RetriedLoginAndStillFailed:
-                pass
+            for template in templates.get((tab_target, match_target, game_target), []):
+                if not template.has("blue", ignore_empty=True):
+                    template.add("blue", item['Team1'])
+                if not template.has("red", ignore_empty=True):
+                    template.add("red", item['Team2'])
+                if not template.has("winner", ignore_empty=True):
+                    template.add("winner", item['WinTeam'])
 
 
 if __name__ == '__main__':
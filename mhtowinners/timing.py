@@ -0,0 +1,34 @@
+import time
+from contextlib import contextmanager
+from typing import Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+
+class PhaseTimer:
+    """Adds up the wall time spent in each phase of a run, in the order the phases were first entered"""
+
+    def __init__(self):
+        self.phases: dict[str, float] = {}
+
+    @contextmanager
+    def time(self, phase: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[phase] = self.phases.get(phase, 0.0) + (time.perf_counter() - start) * 1000
+
+    def iter(self, phase: str, iterable: Iterable[T]) -> Iterator[T]:
+        """Yields from iterable, counting the time spent producing each item towards phase"""
+        iterator = iter(iterable)
+        while True:
+            with self.time(phase):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def format_summary(self) -> str:
+        return '\n'.join(f"{phase}: {ms:.1f}ms" for phase, ms in self.phases.items())
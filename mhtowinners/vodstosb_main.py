@@ -1,17 +1,72 @@
-import mwparserfromhell
-from mwcleric.errors import RetriedLoginAndStillFailed
+from typing import Optional
+
 from mwclient.errors import AssertUserFailedError
 from mwrogue.auth_credentials import AuthCredentials
 from mwrogue.esports_client import EsportsClient
 
+from mhtowinners.pages import update_pages_from_rows
+from mhtowinners.timing import PhaseTimer
+
+# MatchScheduleGame fields holding a VOD, in order of preference
+VOD_PARAMS = ['VodPB', 'VodGameStart', 'Vod', 'VodPostgame']
+
 
 class VodsToSbRunner(object):
-    def __init__(self, site: EsportsClient, vod_params):
+    """Copies VODs from MatchSchedule to the matching scoreboards
+
+    A run can be limited to some overview pages, the whole wiki is checked otherwise. Incremental runs only check
+    rows that Cargo stored after the high water mark of their scope, which every run that saved all of its edits
+    moves forward in the given high_water_marks dict.
+    """
+
+    def __init__(self, site: EsportsClient, vod_params, title_list: Optional[list] = None,
+                 high_water_marks: Optional[dict] = None, incremental: bool = False, dry_run: bool = False):
         self.site = site
         self.summary = 'Discover & auto-add vods to SB - Please double-check for accuracy!'
         self.vod_params = vod_params
+        targets = sorted({site.cache.get_target(title) for title in title_list or [] if title})
+        self.scope = '|'.join(targets)
+        self.title_list = [f'"{title}"' for title in targets]
+        self.high_water_marks = high_water_marks
+        self.incremental = incremental
+        self.dry_run = dry_run
+        self.timer = PhaseTimer()
+        self.diffs = {}
     
     def run(self):
+        with self.timer.time("query"):
+            high_water_mark = self.query_high_water_mark()
+            result = self.query(self.get_since(high_water_mark))
+
+        save_queue = update_pages_from_rows(self.site, result, 'SBPage', self.index_scoreboards,
+                                            self.add_vods_to_page, self.summary, self.timer, self.dry_run)
+        self.diffs = save_queue.diffs
+        if self.high_water_marks is not None and not self.dry_run and not save_queue.failed:
+            self.high_water_marks[self.scope] = high_water_mark
+
+    def query_high_water_mark(self):
+        """Returns the highest row ids currently stored in both tables"""
+        ret = {}
+        for table in ('MatchScheduleGame', 'ScoreboardGames'):
+            result = self.site.cargo_client.query(tables=table, fields='MAX(_ID)=MaxId')
+            ret[table] = int(result[0]['MaxId'] or 0) if result else 0
+        return ret
+
+    def get_since(self, high_water_mark):
+        if not self.incremental or not self.high_water_marks:
+            return None
+        since = self.high_water_marks.get(self.scope)
+        # Row ids start over when a table is recreated, everything has to be checked again then
+        if since is None or any(since.get(table, 0) > max_id for table, max_id in high_water_mark.items()):
+            return None
+        return since
+
+    def query(self, since: Optional[dict] = None):
+        """Returns the scoreboard games whose VOD doesn't match the schedule
+
+        Cargo stores the rows of a page again whenever the page is saved, so when since is given, only games whose
+        schedule or scoreboard row was stored after those row ids are checked.
+        """
         where_condition = ' OR '.join(['MSG.{} IS NOT NULL'.format(_) for _ in self.vod_params])
         vod_options_string = ', '.join(['MSG.{}'.format(_) for _ in self.vod_params])
         fields = [
@@ -22,41 +77,34 @@ class VodsToSbRunner(object):
             'SG.N_GameInMatch=N_GameInMatch',
             'COALESCE(SG.VOD)=SGVod',
         ]
-        result = self.site.cargo_client.query(
+        where = [f"((SG.VOD IS NULL AND SG._pageName IS NOT NULL AND ({where_condition}))"
+                 f" OR (COALESCE(SG.VOD) != COALESCE({vod_options_string})))"]
+        if self.title_list:
+            where.append(f"MSG.OverviewPage IN ({','.join(self.title_list)})")
+        if since is not None:
+            where.append(f"(MSG._ID > {since['MatchScheduleGame']} OR SG._ID > {since['ScoreboardGames']})")
+        return self.site.cargo_client.query(
             tables="MatchScheduleGame=MSG,ScoreboardGames=SG",
             join_on="MSG.GameId=SG.GameId",
-            where=f"(SG.VOD IS NULL AND SG._pageName IS NOT NULL AND ({where_condition}))"
-                  f" OR (COALESCE(SG.VOD) != COALESCE({vod_options_string}))",
+            where=' AND '.join(where),
             fields=', '.join(fields),
             order_by='SG._pageName, SG.N_MatchInPage',  # this is just to group same pages consecutively
         )
-        
-        current_page = {
-            'page': None,
-            'wikitext': None,
-            'page_name': None,
-            'old_text': None,
-        }
-        for item in result:
-            if current_page['page_name'] != item['SBPage']:
-                if current_page['page'] is not None:
-                    self.save_page(current_page)
-                current_page['page_name'] = item['SBPage']
-                current_page['page'] = self.site.client.pages[current_page['page_name']]
-                old_text = current_page['page'].text()
-                current_page['old_text'] = old_text
-                current_page['wikitext'] = mwparserfromhell.parse(old_text)
-                # print('Discovered page {}'.format(current_page['page_name']))
-            self.add_vod_to_page(item, current_page['wikitext'])
-        
-        # we need to catch the last iteration too (assuming we actually did anything)
-        if current_page['page'] is not None:
-            self.save_page(current_page)
     
-    def add_vod_to_page(self, item, wikitext):
+    def add_vods_to_page(self, scoreboards, rows):
+        for item in rows:
+            self.add_vod_to_page(item, scoreboards)
+
+    def add_vod_to_page(self, item, scoreboards):
         # Modify wikitext in place
         n_match_target = int(item['N_MatchInPage'])
         n_game_target = int(item['N_GameInMatch'])
+        for template in scoreboards.get((n_match_target, n_game_target), []):
+            template.add('vodlink', item['Vod'].replace('&amp;', '&'))
+
+    def index_scoreboards(self, wikitext):
+        """Returns the scoreboard templates of a page keyed by (N_MatchInPage, N_GameInMatch)"""
+        scoreboards = {}
         n_match = 0
         n_game_in_match = 0
         for template in wikitext.filter_templates(recursive=False):
@@ -71,10 +119,8 @@ class VodsToSbRunner(object):
             if not name.startswith('Scoreboard/Season') and not name.startswith('MatchRecapS8'):
                 continue
             n_game_in_match += 1
-            if n_game_in_match != n_game_target or n_match != n_match_target:
-                continue
-            # print(item['Vod'])
-            template.add('vodlink', item['Vod'].replace('&amp;', '&'))
+            scoreboards.setdefault((n_match, n_game_in_match), []).append(template)
+        return scoreboards
     
     @staticmethod
     def is_match_placeholder(template):
@@ -91,17 +137,9 @@ class VodsToSbRunner(object):
         if not template.has(1):
             return False
         return template.get(1).value.strip() == 'Game'
-    
-    def save_page(self, page_dict):
-        new_text = str(page_dict['wikitext'])
-        if new_text != page_dict['old_text']:
-            try:
-                self.site.save(page_dict['page'], new_text, summary=self.summary)
-            except RetriedLoginAndStillFailed:
-                pass
 
 
 if __name__ == '__main__':
     credentials = AuthCredentials(user_file='bot')
     lol_site = EsportsClient('lol', credentials=credentials)  # Set wiki
-    VodsToSbRunner(lol_site, ['VodPB', 'VodGameStart', 'Vod', 'VodPostgame']).run()
+    VodsToSbRunner(lol_site, VOD_PARAMS).run()
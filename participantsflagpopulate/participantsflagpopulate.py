@@ -1,5 +1,8 @@
+import asyncio
+
 from mwrogue.esports_client import EsportsClient
 from esports_cog_utils import utils
+from .players import get_player_cache, lookup_players
 from redbot.core import commands, app_commands
 from redbot.core.bot import Red
 import mwparserfromhell
@@ -33,6 +36,7 @@ class ParticipantsFlagPopulate(commands.Cog):
         page_text = page.text()
         page_wikitext = mwparserfromhell.parse(page_text)
 
+        templates = []
         for template in page_wikitext.filter_templates():
             if not template.name.matches("TeamRoster/Line"):
                 continue
@@ -40,21 +44,22 @@ class ParticipantsFlagPopulate(commands.Cog):
                 continue
             if template.get("player").value.strip() == "":
                 continue
-            player_name = template.get("player").value.strip()
-            player_data = site.cargo_client.query(
-                tables="PlayerRedirects=PR, Players=P",
-                join_on="PR.OverviewPage=P.OverviewPage",
-                fields="COALESCE(P.NationalityPrimary, P.Country)=Flag",
-                where=f"PR.AllName = '{player_name}'"
-            )
+            templates.append(template)
+
+        players_data = await asyncio.get_running_loop().run_in_executor(
+            None, lookup_players, site, [template.get("player").value.strip() for template in templates],
+            get_player_cache()
+        )
+
+        for template in templates:
+            player_data = players_data.get(template.get("player").value.strip().lower())
             if not player_data:
                 continue
-            if len(player_data) > 1:
+            if player_data["ambiguous"]:
                 continue
-            player_data = player_data[0]
-            if not player_data["Flag"]:
+            if not player_data["flag"]:
                 continue
-            template.add(name="flag", value=site.cache.get("Country", player_data["Flag"], "flag"))
+            template.add(name="flag", value=site.cache.get("Country", player_data["flag"], "flag"))
 
         if page_text != str(page_wikitext):
             site.save_title(title=page_title, text=str(page_wikitext), summary="Automatically populating player flags")
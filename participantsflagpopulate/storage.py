@@ -0,0 +1,37 @@
+import json
+import os
+from typing import Any, Union
+
+
+def read_json(path: str) -> Any:
+    """Returns the content of a JSON file, or None if it doesn't exist or can't be read"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_atomic(path: str, data: Union[str, bytes]) -> None:
+    """Replaces a file at once, readers see either its previous content or the new one but never a partial file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if isinstance(data, bytes):
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+    else:
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def write_json(path: str, data: Any) -> None:
+    write_atomic(path, json.dumps(data))
+
+
+def remove_file(path: str) -> bool:
+    """Deletes a file, returns whether there was one to delete"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    return True
@@ -0,0 +1,55 @@
+import asyncio
+import json
+import os
+import re
+import time
+from typing import Optional
+
+from aiohttp import ClientSession
+
+from patchupdate.storage import read_json, write_atomic
+
+DDRAGON_V = "https://ddragon.leagueoflegends.com/api/versions.json"
+DDRAGON = "http://ddragon.leagueoflegends.com/cdn/{}/data/en_US/{}.json"
+
+# The version list changes when a patch is released, so it is only reused for a short while
+VERSIONS_TTL = 10 * 60
+
+
+class DDragonCache:
+    """Downloads Data Dragon files through a shared session and keeps them in cache_dir
+
+    The data of a given version never changes, so it is downloaded once and then always read from disk.
+    """
+
+    def __init__(self, session: ClientSession, cache_dir: str):
+        self.session = session
+        self.cache_dir = cache_dir
+        self._versions: Optional[list] = None
+        self._versions_fetched_at = 0.0
+        self._locks: dict[str, asyncio.Lock] = {}
+
+    async def get_latest_version(self) -> str:
+        if self._versions is None or time.time() - self._versions_fetched_at >= VERSIONS_TTL:
+            async with self.session.get(DDRAGON_V) as resp:
+                resp.raise_for_status()
+                self._versions = json.loads(await resp.read())
+            self._versions_fetched_at = time.time()
+        return self._versions[0]
+
+    async def get_data(self, version: str, section: str) -> dict:
+        if not re.fullmatch(r'[\w.]+', version) or not re.fullmatch(r'\w+', section):
+            raise ValueError(f"Invalid Data Dragon version or section: {version} {section}")
+        path = os.path.join(self.cache_dir, version, f"{section}.json")
+        loop = asyncio.get_running_loop()
+        # Concurrent requests for the same file wait for the first download instead of starting their own
+        async with self._locks.setdefault(path, asyncio.Lock()):
+            data = await loop.run_in_executor(None, read_json, path)
+            # A missing or unreadable file is downloaded again
+            if data is not None:
+                return data
+            async with self.session.get(DDRAGON.format(version, section)) as resp:
+                resp.raise_for_status()
+                raw = await resp.read()
+            await loop.run_in_executor(None, write_atomic, path, raw)
+        return await loop.run_in_executor(None, json.loads, raw)
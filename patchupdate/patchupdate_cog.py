@@ -1,5 +1,4 @@
 import asyncio
-import json
 import re
 from io import BytesIO
 from typing import Optional
@@ -9,28 +8,24 @@ from esports_cog_utils.utils import login_if_possible
 from mwrogue.auth_credentials import AuthCredentials
 from mwrogue.esports_client import EsportsClient
 from redbot.core import commands
+from redbot.core.data_manager import cog_data_path
 
 from patchupdate.champion_modifier import ChampionModifier
+from patchupdate.ddragon import DDragonCache
 from patchupdate.item_modifier import ItemModifier
 
-DDRAGON_V = "https://ddragon.leagueoflegends.com/api/versions.json"
-DDRAGON = "http://ddragon.leagueoflegends.com/cdn/{}/data/en_US/{}.json"
-
 TEMPLATE_MODIFIERS = {
     'champion': ChampionModifier,
     'item': ItemModifier,
 }
 
 
-async def updatestats(site: EsportsClient, section: str, version: Optional[str] = None):
-    async with aiohttp.ClientSession() as session:
-        if version is None:
-            async with session.get(DDRAGON_V) as resp:
-                version = json.loads(await resp.text())[0]
-        elif not re.match(r'\d+\.\d+\.\d+', version):
-            version += ".1"
-        async with session.get(DDRAGON.format(version, section)) as resp:
-            data = json.loads(await resp.text())['data']
+async def updatestats(site: EsportsClient, section: str, ddragon: DDragonCache, version: Optional[str] = None):
+    if version is None:
+        version = await ddragon.get_latest_version()
+    elif not re.match(r'\d+\.\d+\.\d+', version):
+        version += ".1"
+    data = (await ddragon.get_data(version, section))['data']
 
     tm = TEMPLATE_MODIFIERS[section](site, "Infobox " + section.title(), data=data,
                                      summary=section.title() + " Update for " + version)
@@ -43,6 +38,11 @@ class PatchUpdate(commands.Cog):
     def __init__(self, bot):
         super().__init__()
         self.bot = bot
+        self.session = aiohttp.ClientSession()
+        self.ddragon = DDragonCache(self.session, str(cog_data_path(self) / "ddragon"))
+
+    def cog_unload(self):
+        self.bot.loop.create_task(self.session.close())
 
     async def red_get_data_for_user(self, *, user_id):
         """Get a user's personal data."""
@@ -65,7 +65,7 @@ class PatchUpdate(commands.Cog):
         await ctx.send("Okay, starting!")
         site = await login_if_possible(ctx, self.bot, 'lol')
         async with ctx.typing():
-            await updatestats(site, "champion", version)
+            await updatestats(site, "champion", self.ddragon, version)
         await ctx.send("Okay, done!")
 
     @patchupdate.command()
@@ -73,11 +73,16 @@ class PatchUpdate(commands.Cog):
         await ctx.send("Okay, starting!")
         site = await login_if_possible(ctx, self.bot, 'lol')
         async with ctx.typing():
-            await updatestats(site, "item", version)
+            await updatestats(site, "item", self.ddragon, version)
         await ctx.send("Okay, done!")
 
 
+async def main(site: EsportsClient, section: str):
+    async with aiohttp.ClientSession() as session:
+        await updatestats(site, section, DDragonCache(session, "ddragon_cache"))
+
+
 if __name__ == "__main__":
     lolsite = EsportsClient('lol', credentials=AuthCredentials(user_file='me'))
-    asyncio.run(updatestats(lolsite, "champion"))
-    # asyncio.run(updatestats(lolsite, "item"))
+    asyncio.run(main(lolsite, "champion"))
+    # asyncio.run(main(lolsite, "item"))
@@ -1,12 +1,33 @@
+import html
+from typing import Optional
+
 from mwcleric.template_modifier import TemplateModifierBase
 
 
+def normalize_name(name: str) -> str:
+    return ' '.join(html.unescape(name).split()).casefold()
+
+
 class TemplateModifier(TemplateModifierBase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ddids_by_name = self.index_ddids(self.data['data'])
+
+    @staticmethod
+    def index_ddids(data: dict) -> dict[str, Optional[str]]:
+        """Maps every normalized DDragon name to its id, or to None if more than one entry has that name"""
+        ddids_by_name = {}
+        for ddid, entry in data.items():
+            name = normalize_name(entry.get('name') or '')
+            if not name:
+                continue
+            ddids_by_name[name] = None if name in ddids_by_name else ddid
+        return ddids_by_name
+
     def update_template(self, template):
-        key = [k for k, v in self.data['data'].items()
-               if v.get('name') == self.current_template.get('name', '').value.strip()]
-        if len(key) == 1:
-            ddid = key[0]
+        name = self.current_template.get('name').value if self.current_template.has('name') else ''
+        ddid = self.ddids_by_name.get(normalize_name(str(name)))
+        if ddid is not None:
             self.current_template.add('ddragon_key', ddid)
         else:
             self.site.log_error_content(self.current_page.name, "Duplicate or missing DDragon data")